@@ -0,0 +1,147 @@
+"""ai.py - Computer opponent backed by a precomputed transposition table.
+
+Every position reachable in a game is solved once, at import, with negamax.
+Positions are stored from the point of view of the player about to move
+(always written as PLAYER1_CELL) and canonicalised under the 8 symmetries of
+the board, so the table stays small and a request only does a dictionary
+lookup, no search."""
+
+import random
+import sys
+import time
+
+import board
+from logs import get_logger
+from board import BOARD_SIZE, EMPTY_CELL, PLAYER1_CELL, PLAYER2_CELL,\
+    EMPTY_BOARD, cell_index
+
+# Chance of playing the best move, otherwise a random legal move is played
+DIFFICULTIES = {
+    'easy': 0.3,
+    'medium': 0.7,
+    'hard': 1.0,
+}
+
+WIN_SCORE = 10
+
+
+def _symmetries():
+    """Each symmetry is a tuple perm where transformed[i] = original[perm[i]]"""
+    n = BOARD_SIZE - 1
+    transforms = [
+        lambda x, y: (x, y),
+        lambda x, y: (y, n - x),
+        lambda x, y: (n - x, n - y),
+        lambda x, y: (n - y, x),
+        lambda x, y: (x, n - y),
+        lambda x, y: (n - x, y),
+        lambda x, y: (y, x),
+        lambda x, y: (n - y, n - x),
+    ]
+    perms = []
+    for transform in transforms:
+        perm = [0] * (BOARD_SIZE * BOARD_SIZE)
+        for x in range(BOARD_SIZE):
+            for y in range(BOARD_SIZE):
+                perm[cell_index(x, y)] = cell_index(*transform(x, y))
+        perms.append(tuple(perm))
+    return perms
+
+
+SYMMETRIES = _symmetries()
+_SWAP = {PLAYER1_CELL: PLAYER2_CELL, PLAYER2_CELL: PLAYER1_CELL,
+         EMPTY_CELL: EMPTY_CELL}
+
+
+def _swap_players(cells):
+    return ''.join(_SWAP[cell] for cell in cells)
+
+
+def canonical(cells):
+    """Returns (canonical board, perm), canonical cell i is cells[perm[i]]"""
+    best = None
+    for perm in SYMMETRIES:
+        transformed = ''.join(cells[i] for i in perm)
+        if best is None or transformed < best[0]:
+            best = (transformed, perm)
+    return best
+
+
+def _solve(cells, table):
+    """Negamax score of cells for PLAYER1_CELL to move, filling table with
+    canonical board -> (score, ((cell, score), ...))"""
+    cells = canonical(cells)[0]
+    if cells in table:
+        return table[cells][0]
+
+    move_scores = []
+    empty_cells = cells.count(EMPTY_CELL)
+    for i, cell in enumerate(cells):
+        if cell != EMPTY_CELL:
+            continue
+        played = cells[:i] + PLAYER1_CELL + cells[i + 1:]
+        result = board.evaluate(*board.to_masks(played))
+        if result == board.PLAYER1_WINS:
+            # Prefer the quickest win and the slowest loss
+            score = WIN_SCORE + empty_cells
+        elif result == board.DRAW:
+            score = 0
+        else:
+            score = -_solve(_swap_players(played), table)
+        move_scores.append((i, score))
+
+    best = max(score for _, score in move_scores)
+    table[cells] = (best, tuple(move_scores))
+    return best
+
+
+def _build_table():
+    table = {}
+    # Either player may open, so solve the empty board and every reply to
+    # an opening move by the other player
+    _solve(EMPTY_BOARD, table)
+    for i in range(len(EMPTY_BOARD)):
+        opened = EMPTY_BOARD[:i] + PLAYER2_CELL + EMPTY_BOARD[i + 1:]
+        _solve(opened, table)
+    return table
+
+
+def _table_size_bytes(table):
+    size = sys.getsizeof(table)
+    for cells, (score, move_scores) in table.items():
+        size += sys.getsizeof(cells) + sys.getsizeof(move_scores)
+        size += sum(sys.getsizeof(move) for move in move_scores)
+    return size
+
+
+_started = time.time()
+TABLE = _build_table()
+TABLE_BUILD_SECONDS = time.time() - _started
+TABLE_SIZE_BYTES = _table_size_bytes(TABLE)
+get_logger('ai').info('transposition table built', positions=len(TABLE),
+                      build_ms=int(TABLE_BUILD_SECONDS * 1000),
+                      size_kb=TABLE_SIZE_BYTES // 1024)
+
+
+def choose_move(cells, marker, difficulty='hard'):
+    """Returns the (x, y) marker should play on the packed board cells, None
+    if the game is already over. Raises ValueError on unknown difficulty"""
+    if difficulty not in DIFFICULTIES:
+        raise ValueError('Unknown difficulty: {0}'.format(difficulty))
+    if board.evaluate(*board.to_masks(cells)) != board.ONGOING:
+        return None
+
+    if marker != PLAYER1_CELL:
+        cells = _swap_players(cells)
+    canonical_cells, perm = canonical(cells)
+    entry = TABLE.get(canonical_cells)
+    if entry is None:
+        # Not reachable by alternating moves, nothing sensible to suggest
+        return None
+    best, move_scores = entry
+
+    if random.random() < DIFFICULTIES[difficulty]:
+        candidates = [i for i, score in move_scores if score == best]
+    else:
+        candidates = [i for i, _ in move_scores]
+    return divmod(perm[random.choice(candidates)], BOARD_SIZE)
@@ -8,17 +8,35 @@ import sys
 import logging
 import endpoints
 import time
+import collections
+import datetime
 from protorpc import remote, messages
 from protorpc import message_types
 
-from google.appengine.api import memcache
+from google.appengine.api import oauth
 from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
-from models import User, Game, Score, Move
+import board
+from board import BOARD_SIZE, MIN_BOARD_SIZE, MAX_BOARD_SIZE
+from models import User, Game, Score, MoveEvent, MAX_MOVE_EVENTS, MAX_GAME_CHILDREN
 from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
-    ScoreForms
+    ScoreForms, GameIdForm, GameIdForms, MetricsForm, MetricsForms, MoveForms,\
+    MoveResultForm, MoveResultForms, MoveEventForms, PlayerStatsForm,\
+    PlayerStatsForms, GameStatsForm, GameStateForm, MatchmakingForm
 from utils import get_by_urlsafe
+from logs import get_logger
+from metrics import instrumented
+import metrics
+import cache
+import ai
+import leaderboard
+import game_stats
+import matchmaking
+import idempotency
+from game_context import GameContext
 
 # NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 # GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -31,15 +49,80 @@ from utils import get_by_urlsafe
 #                                            email=messages.StringField(2))
 
 START_GAME = endpoints.ResourceContainer(game_id = messages.StringField(1), 
-                                         player1=messages.StringField(2), player2=messages.StringField(3))
+                                         player1=messages.StringField(2), player2=messages.StringField(3),
+                                         size = messages.IntegerField(4, default = BOARD_SIZE),
+                                         run_length = messages.IntegerField(5),
+                                         idempotency_key = messages.StringField(6))
 
 GAME_ID = endpoints.ResourceContainer(game_id = messages.StringField(1))
 
+GAME_STATE_REQUEST = endpoints.ResourceContainer(
+     game_id = messages.StringField(1), known_version = messages.IntegerField(2))
+
+WAIT_FOR_MOVE_REQUEST = endpoints.ResourceContainer(
+     game_id = messages.StringField(1), known_version = messages.IntegerField(2),
+     timeout = messages.IntegerField(3, default = 20))
+
+# Longest wait_for_move hold, in seconds, within the request deadline
+MAX_WAIT_TIMEOUT = 50
+# Suggested delay before polling again after a wait_for_move that didn't wait
+WAIT_RETRY_AFTER_MS = 1000
+
 MAKE_NEXT_MOVE_REQUEST = endpoints.ResourceContainer(
      x = messages.IntegerField(1), y = messages.IntegerField(2),
-      user_id=messages.StringField(3), game_id=messages.StringField(4))
+      user_id=messages.StringField(3), game_id=messages.StringField(4),
+      idempotency_key = messages.StringField(5))
+
+MAKE_AI_MOVE_REQUEST = endpoints.ResourceContainer(
+     user_id = messages.StringField(1), game_id = messages.StringField(2),
+     difficulty = messages.StringField(3, default = 'hard'))
+
+UNDO_MOVE_REQUEST = endpoints.ResourceContainer(
+     user_id = messages.StringField(1), game_id = messages.StringField(2))
+
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+     message_types.VoidMessage,
+     limit = messages.IntegerField(1, default = 10))
+
+JOIN_MATCHMAKING_REQUEST = endpoints.ResourceContainer(
+     user_id = messages.StringField(1), size = messages.IntegerField(2, default = BOARD_SIZE),
+     run_length = messages.IntegerField(3), ticket = messages.StringField(4))
+
+USER_ID = endpoints.ResourceContainer(user_id = messages.StringField(1))
+
+PURGE_GAMES_REQUEST = endpoints.ResourceContainer(
+     older_than_days = messages.IntegerField(1, default = 30))
+
+# Format of the cutoff passed to the /tasks/purge_games handler
+PURGE_CUTOFF_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+SHOW_GAME_IDS_REQUEST = endpoints.ResourceContainer(
+     message_types.VoidMessage,
+     page_size = messages.IntegerField(1), cursor = messages.StringField(2),
+     status = messages.StringField(3), player = messages.StringField(4),
+     include_board = messages.BooleanField(5, default = False))
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Game state checks run on every poll, only trace a fraction of them
+STATE_LOG_SAMPLE_RATE = 0.01
+
+log = get_logger('api')
+
+# Attempts made by ndb before a contended move is reported as a conflict
+MOVE_TRANSACTION_RETRIES = 3
+
+WRONG_GAME_ID = "Invalid Move, Wrong Game ID"
+# Returned by the move transaction when a request with the same idempotency
+# key already made the move
+DUPLICATE_REQUEST = "Duplicate request"
+CONFLICT_MESSAGE = "Game {0} is being updated by another move, please retry"
+
+MAX_BATCH_MOVES = 500
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+# Opponents taken from the matchmaking pool before waiting for one
+MATCH_ATTEMPTS = 3
 
 @endpoints.api(name='guess_a_number', version='v1')
 class GuessANumberApi(remote.Service):
@@ -48,386 +131,857 @@ class GuessANumberApi(remote.Service):
 
 
     @endpoints.method(request_message=START_GAME,
-                      response_message=StringMessage,
+                      response_message=GameStateForm,
                       path='start_game',
                       name='start_game',
                       http_method='POST')
-
+    @instrumented
     def startGame(self, request):
-      """ Initializes all 9 posible moves using provided game_id """
+      """ Creates a new game with an empty board using provided game_id. Returns
+      its state. size (3 by default, up to 19) sets a size x size board, won
+      with run_length in a row (the board size up to five by default). A retry
+      sent with the same idempotency_key gets the first response back """
 
       game_id = request.game_id
       player1 = request.player1
       player2 = request.player2
+      idempotency_key = request.idempotency_key
 
       if request.game_id == None:
-        return StringMessage(message = "Failed, Empty game_id. Please enter a valid unique game_id")
+        return GameStateForm(message = "Failed, Empty game_id. Please enter a valid unique game_id")
+
+      GuessANumberApi._check_idempotency_key(idempotency_key)
+      response = idempotency.cached_response(Game.key_for(game_id), "start_game", idempotency_key, GameStateForm)
+      if response != None:
+        return response
 
       if request.player1 == None or request.player2 == None:
-        return StringMessage(message = "Failed, Missing Players. Make sure both player ids are present")        
+        return GameStateForm(message = "Failed, Missing Players. Make sure both player ids are present")
 
       if request.player1 == request.player2:
-        return StringMessage(message = "Failed, Player Ids must be different")                
+        return GameStateForm(message = "Failed, Player Ids must be different")
 
-      
+      size = request.size
+      run_length = request.run_length or board.default_run_length(size)
 
-      game_exists = len(Move.query(Move.game_id == game_id).fetch()) > 0
-      if game_exists:
-        return StringMessage(message = "Game Creation Failed, Game ID already exists: {0}".format( game_id ) )
+      error = GuessANumberApi._check_board(size, run_length)
+      if error != None:
+        return GameStateForm(message = "Failed, {0}".format(error))
 
-      # Creating Game
-      game = Game(game_id = game_id, player1 = request.player1, player2 = request.player2)
-      game.put()
+      # Creating Game, keyed by game_id so the existence check and the write
+      # happen in one transaction
+      message = "New Game Created, ID: {0} | Player 1: {1} | Player 2: {2}".format( game_id, player1, player2 )
+      try:
+        game = GuessANumberApi._create_game(game_id, request.player1, request.player2, size, run_length,
+                                            idempotency_key = idempotency_key, message = message)
+      except datastore_errors.TransactionFailedError:
+        log.warning("game creation conflict", game_id = game_id)
+        raise endpoints.ConflictException(CONFLICT_MESSAGE.format(game_id))
 
-      print("New Game Created: {0}".format(game))        
+      if game == None:
+        # The game may have been created by an earlier try of this request
+        if idempotency_key != None:
+          response = idempotency.get_response(Game.key_for(game_id), "start_game", idempotency_key, GameStateForm)
+          if response != None:
+            return response
+
+        return GameStateForm(message = "Game Creation Failed, Game ID already exists: {0}".format( game_id ) )
+
+      log.info("game created", game_id = game_id, player1 = player1, player2 = player2)
+
+      return game.to_form(message)
+
+
+    @endpoints.method(request_message = JOIN_MATCHMAKING_REQUEST, response_message = MatchmakingForm,
+                      path = "join_matchmaking", name = "join_matchmaking", http_method = "POST")
+    @instrumented
+    def join_matchmaking(self, request):
+      """ Pairs user_id with another player looking for the same board size and
+      run length, and creates their game. The call waits for an opponent for up
+      to 20 seconds, then returns a ticket to send back with the next call to
+      keep the player's place. Both players get the game once paired, a ticket
+      whose game was deleted since is not found """
+      if request.user_id == None:
+        raise endpoints.BadRequestException("user_id is required")
+
+      if request.ticket != None:
+        ticket = matchmaking.get_ticket(request.ticket)
+        if ticket == None or ticket.user_id != request.user_id:
+          raise endpoints.NotFoundException("No matchmaking ticket {0} for user: {1}"
+                                            .format(request.ticket, request.user_id))
+      else:
+        size = request.size
+        run_length = request.run_length or board.default_run_length(size)
 
-      mv1 = Move(x = 0, y = 0, game_id = game_id, available = True, description = "[0,0]")
-      mv2 = Move(x = 0, y = 1, game_id = game_id, available = True, description = "[0,1]")
-      mv3 = Move(x = 0, y = 2, game_id = game_id, available = True, description = "[0,2]")
+        error = GuessANumberApi._check_board(size, run_length)
+        if error != None:
+          raise endpoints.BadRequestException(error)
 
-      mv4 = Move(x = 1, y = 0, game_id = game_id, available = True, description = "[1,0]")
-      mv5 = Move(x = 1, y = 1, game_id = game_id, available = True, description = "[1,1]")
-      mv6 = Move(x = 1, y = 2, game_id = game_id, available = True, description = "[1,2]")
+        ticket = matchmaking.new_ticket(request.user_id, size, run_length)
 
-      mv7 = Move(x = 2, y = 0, game_id = game_id, available = True, description = "[2,0]")
-      mv8 = Move(x = 2, y = 1, game_id = game_id, available = True, description = "[2,1]")
-      mv9 = Move(x = 2, y = 2, game_id = game_id, available = True, description = "[2,2]")
+      ticket_id = ticket.key.id()
+      game_id = ticket.game_id
 
-      # ndb.put_multi([ mv1, mv2, mv3, mv4, mv5, mv6, mv7, mv8, mv9])
+      for _ in range(MATCH_ATTEMPTS):
+        if game_id != None:
+          break
+        opponent_ticket_id = matchmaking.pair(ticket)
+        if opponent_ticket_id == None:
+          break
+        game_id = GuessANumberApi._create_matched_game(opponent_ticket_id, ticket)
+        if game_id == None:
+          # Either this player was paired meanwhile, or the opponent taken from
+          # the pool was and another one is needed
+          game_id = matchmaking.get_ticket(ticket_id).game_id
 
-      for m in [ mv1, mv2, mv3, mv4, mv5, mv6, mv7, mv8, mv9]:
-        print(" saving: {0}".format(m) )
-        m.put()
+      if game_id == None:
+        game_id = matchmaking.wait_for_game(ticket_id)
 
-      return StringMessage(message = "New Game Created, ID: {0} | Player 1: {1} | Player 2: {2}".format( game_id, player1, player2 ) )
+      if game_id == None:
+        return MatchmakingForm(ticket = ticket_id, matched = False)
+
+      game = cache.get_game_async(game_id).get_result()
+
+      # The game may have been reset or purged since the players were paired
+      if game == None:
+        raise endpoints.NotFoundException("Game {0} of matchmaking ticket {1} no longer exists, join without the ticket"
+                                          .format(game_id, ticket_id))
+
+      return MatchmakingForm(ticket = ticket_id, matched = True,
+                             game = game.to_form("Matched, Game ID: {0} | Player 1: {1} | Player 2: {2}"
+                                                 .format(game_id, game.player1, game.player2)))
 
 
     @endpoints.method(request_message = GAME_ID, response_message = StringMessage,
                       path = "game_reset", name = "game_reset", http_method = "POST")
+    @instrumented
     def resetGameState(self, request):
-      # Remove move ownership for all users
-      # Resets move availablities to True
+      # Deletes the game and its move log
       game_id = request.game_id
 
-      # for the moment, resets every move for provided game_id
-      moves = Move.query().fetch()
-      moves_deleted = Move.query(Move.game_id == game_id).fetch()
-
-
-      game = Game.query(Game.game_id == game_id).get()
+      game = Game.get_by_game_id(game_id)
 
       if game == None:
         return StringMessage(message = "No Game found for ID:  {0} ".format(game_id))
 
-      print("game id is {0} {1}".format(game_id, moves[0].game_id ))
+      entities_deleted = GuessANumberApi._delete_games_async([game.key]).get_result()
+      log.info("game reset", game_id = game_id, entities_deleted = entities_deleted)
+
+      return StringMessage(message = "Game Reset Complete, deleted {0} moves for Game:  {1} ".format(game.move_count, game_id))
+
+
+    @endpoints.method(request_message = PURGE_GAMES_REQUEST, response_message = StringMessage,
+                      path = "purge_games", name = "purge_games", http_method = "POST")
+    @instrumented
+    def purgeGames(self, request):
+      """ Admin only. Schedules the deletion of every game, finished or abandoned,
+      not updated in older_than_days. The deletion runs in task queue batches """
+      GuessANumberApi._require_admin()
 
-      # Deleting Game
-      game.key.delete()
+      if request.older_than_days < 0:
+        raise endpoints.BadRequestException("older_than_days must not be negative")
 
-      # Deleting Moves
-      for move in moves_deleted:
-        print("Deleting moves, {0}".format(move))
-        move.key.delete()
+      cutoff = datetime.datetime.utcnow() - datetime.timedelta(days = request.older_than_days)
+      taskqueue.add(url = '/tasks/purge_games',
+                    params = {'cutoff': cutoff.strftime(PURGE_CUTOFF_FORMAT)})
 
-      return StringMessage(message = "Game Reset Complete, deleted {0} moves for Game:  {1} ".format(len(moves_deleted), game_id))
+      return StringMessage(message = "Purge scheduled for games not updated since {0}".format(cutoff))
 
 
-    @endpoints.method(request_message= MAKE_NEXT_MOVE_REQUEST, response_message = StringMessage,
+    @endpoints.method(request_message= MAKE_NEXT_MOVE_REQUEST, response_message = GameStateForm,
                       name = "make_move", path="make_move", http_method="POST" )
+    @instrumented
     def makeMove(self, request):
-      """ Asigns specific move to a user for a specific game_id, as long as its available """
+      """ Asigns specific move to a user for a specific game_id, as long as its available.
+      Returns the game state after the move, or only a message if it was rejected.
+      A retry sent with the same idempotency_key as an applied move gets the
+      first response back, rejected moves are not stored and run again """
       x = request.x   
       y = request.y
       game_id = request.game_id
       user_id = request.user_id
+      idempotency_key = request.idempotency_key
+      started = time.time()
+
+      GuessANumberApi._check_idempotency_key(idempotency_key)
+      if game_id != None:
+        response = idempotency.cached_response(Game.key_for(game_id), "make_move", idempotency_key, GameStateForm)
+        if response != None:
+          return response
+
+      game, message = GuessANumberApi._apply_move(GameContext(game_id), user_id, x, y,
+                                                  idempotency_key = idempotency_key)
+
+      if message == DUPLICATE_REQUEST:
+        response = idempotency.get_response(Game.key_for(game_id), "make_move", idempotency_key, GameStateForm)
+        # Only missing if it expired in between
+        return response or GameStateForm(message = "Move already applied", game_id = game_id)
+
+      if game != None:
+        log.info("move applied", game_id = game_id, user_id = user_id, x = x, y = y,
+                 latency_ms = int((time.time() - started) * 1000))
+        GuessANumberApi._show_game_picture(game)
+        return game.to_form(message)
+
+      return GameStateForm(message = message, game_id = game_id)
+
+    @endpoints.method(request_message = MoveForms, response_message = MoveResultForms,
+                      name = "make_moves_batch", path = "make_moves_batch", http_method = "POST")
+    @instrumented
+    def make_moves_batch(self, request):
+      """ Applies an ordered list of moves, possibly spanning many games. Moves are
+      grouped per game and each group is validated and applied in one
+      transaction. Returns one result per move, in request order """
+
+      if len(request.moves) > MAX_BATCH_MOVES:
+        raise endpoints.BadRequestException(
+          "At most {0} moves can be sent in one batch".format(MAX_BATCH_MOVES))
+
+      groups = collections.OrderedDict()
+      for i, move in enumerate(request.moves):
+        groups.setdefault(move.game_id, []).append(i)
+
+      @ndb.tasklet
+      def apply_group(game_id, moves):
+        try:
+          _, group_results = yield GuessANumberApi._apply_moves_async(GameContext(game_id), moves)
+        except datastore_errors.TransactionFailedError:
+          log.warning("batch move conflict", game_id = game_id, moves = len(moves))
+          group_results = [(False, CONFLICT_MESSAGE.format(game_id))] * len(moves)
+        raise ndb.Return(group_results)
+
+      # Every game is its own entity group, so the groups run concurrently
+      futures = []
+      for game_id, indexes in groups.items():
+        moves = [(request.moves[i].user_id, request.moves[i].x, request.moves[i].y)
+                 for i in indexes]
+        futures.append(apply_group(game_id, moves))
+
+      results = [None] * len(request.moves)
+      for indexes, future in zip(groups.values(), futures):
+        for i, (applied, message) in zip(indexes, future.get_result()):
+          move = request.moves[i]
+          results[i] = MoveResultForm(game_id = move.game_id, user_id = move.user_id,
+                                      x = move.x, y = move.y, applied = applied,
+                                      message = message)
+
+      log.info("batch applied", games = len(groups), moves = len(results),
+               applied = len([result for result in results if result.applied]))
+      return MoveResultForms(results = results)
+
+    @endpoints.method(request_message = MAKE_AI_MOVE_REQUEST, response_message = StringMessage,
+                      name = "make_ai_move", path = "make_ai_move", http_method = "POST")
+    @instrumented
+    def make_ai_move(self, request):
+      """ Plays the next move for user_id, chosen by the computer. difficulty is
+      easy, medium or hard (optimal play) """
+      game_id = request.game_id
+      user_id = request.user_id
 
-      game = Game.query(Game.game_id == game_id).get()
-      queried_move = Move.query(Move.x == x, Move.y == y, 
-                        Move.game_id == game_id).fetch(1)
-
-      if game == None :
-        print("\n\nInvalid Move, Wrong Game ID\n\n")
-        return StringMessage(message = "Invalid Move, Wrong Game ID" )
- 
-      winner_id = GuessANumberApi._check_winning_condition(game_id) 
+      if request.difficulty not in ai.DIFFICULTIES:
+        raise endpoints.BadRequestException(
+          "difficulty must be one of: {0}".format(", ".join(sorted(ai.DIFFICULTIES))))
 
-      if winner_id != False:
-        print("\n\n Game Won By {0} \n\n".format(winner_id))
-        return StringMessage(message = "\n\n Game Won By {0} \n\n".format(winner_id))             
+      context = GameContext(game_id)
+      game = context.get_game_async().get_result()
 
-      available_moves = Move.query(Move.available == True, Move.game_id == game_id).fetch()
-      
-      if len(available_moves) == 0:
-        print("\n\n Game Ended, No more moves left {0} \n\n".format(game_id))
-        return "no_more_moves"        
+      if game == None:
+        return StringMessage(message = WRONG_GAME_ID)
 
-      if user_id == None or user_id not in [game.player1, game.player2]:
-        print("\n\nInvalid move parameters\n\n")
+      marker = game.marker_for(user_id)
+      if marker == None:
         return StringMessage(message = "Invalid Move, Wrong User ID" )
 
-      if len(queried_move) == 0:
-        print("\n\nInvalid move parameters\n\n")
-        return StringMessage(message = "Invalid move parameters, Wrong Game ID or Move out of range" )
+      if game.size != BOARD_SIZE or game.run_length != BOARD_SIZE:
+        return StringMessage(message = "The computer only plays {0}x{0} games".format(BOARD_SIZE))
 
-      if user_id == game.last_play_user_id:
-        print("\n\n This Player already moved\n\n")
-        return StringMessage(message = "Invalid move, This Player already moved" )        
+      move = ai.choose_move(game.board, marker, request.difficulty)
+      if move == None:
+        return StringMessage(message = "Game Ended: {0}".format(GuessANumberApi._check_game_state(game)))
 
-      move = queried_move[0]
-      if move.available != True:
-        print("\n\nMove already done by: {0} \n\n".format(move.user_id))
-        return StringMessage(message = "Move {0} has already been made by User with ID: : {1}"
-                             .format(move.description, move.user_id) )        
+      x, y = move
+      game, message = GuessANumberApi._apply_move(context, user_id, x, y)
 
-      move.user_id = user_id
-      move.available = False
-      move.put()
+      if game != None:
+        GuessANumberApi._show_game_picture(game)
 
-      game.last_play_user_id = user_id
-      game.put()
+      return StringMessage(message = message)
 
-      GuessANumberApi._show_game_picture(game_id)
-      GuessANumberApi._check_game_state(game_id)
+    @endpoints.method(request_message = UNDO_MOVE_REQUEST, response_message = StringMessage,
+                      name = "undo_move", path = "undo_move", http_method = "POST")
+    @instrumented
+    def undo_move(self, request):
+      """ Takes back the last move of a game, only for the player who made it.
+      The board is rebuilt from the game's move log and the undo is logged too """
+      game_id = request.game_id
+      user_id = request.user_id
 
-      return StringMessage(message = "Move {0} assign to {1} for game_id: {2}, x:{3} and y:{4}".format(move.description, user_id, game_id, x, y) )
+      try:
+        game, event = GuessANumberApi._undo_move_async(GameContext(game_id), user_id).get_result()
+      except ValueError as error:
+        log.debug("undo rejected", game_id = game_id, user_id = user_id, reason = error)
+        return StringMessage(message = "Invalid Undo, {0}".format(error))
+      except datastore_errors.TransactionFailedError:
+        log.warning("undo conflict", game_id = game_id, user_id = user_id)
+        raise endpoints.ConflictException(CONFLICT_MESSAGE.format(game_id))
 
-    @endpoints.method(request_message = GAME_ID, response_message = StringMessage,
+      if game == None:
+        return StringMessage(message = WRONG_GAME_ID)
+
+      log.info("move undone", game_id = game_id, user_id = user_id, x = event.x, y = event.y,
+               version = game.version)
+      GuessANumberApi._show_game_picture(game)
+
+      return StringMessage(message = "Move [{0},{1}] by {2} undone for game_id: {3}"
+                           .format(event.x, event.y, user_id, game_id))
+
+    @endpoints.method(request_message = GAME_ID, response_message = MoveEventForms,
+                      path = "game_history", name = "game_history", http_method = "GET")
+    @instrumented
+    def game_history(self, request):
+      """ Returns the move log of a game, oldest first, undone moves and undos
+      included. Games started before the move log only list their later moves """
+      game_id = request.game_id
+
+      game_future = Game.get_by_game_id_async(game_id)
+      events = MoveEvent.history_query(Game.key_for(game_id)).fetch(MAX_MOVE_EVENTS) if game_id else []
+
+      if game_future.get_result() == None:
+        raise endpoints.NotFoundException("Game doesnt exist for ID: {0}".format(game_id))
+
+      return MoveEventForms(items = [event.to_form() for event in events])
+
+    @endpoints.method(request_message = GAME_STATE_REQUEST, response_message = GameStateForm,
                       path = "check_game_state", name = "check_game_state", http_method = "POST")
+    @instrumented
     def checkGameState(self, request):
+      """ Returns the state of a game. When known_version is the version the
+      client already has and it is still current, only not_modified is set """
       game_id = request.game_id
-      game = Game.query(Game.game_id == game_id).get()
+      game, state = GuessANumberApi._get_game_state_async(GameContext(game_id)).get_result()
 
       if game == None:
-        print("\n\n Game doesnt exist for ID: {0} \n\n".format(game_id))
-        return StringMessage(message = "Game doesnt exist for ID: {0} "
+        log.debug("game not found", game_id = game_id)
+        return GameStateForm(message = "Game doesnt exist for ID: {0} "
                              .format(game_id) )  
 
-      state = GuessANumberApi._check_game_state(game_id)   
-      
-      if state == "no_more_moves":
-        print("\n\n Game Ended, No Winners: {0} \n\n".format(game_id))
-        return StringMessage(message = "Game Ended, No Winners: {0} "
-                             .format(game_id) )  
+      if request.known_version != None and request.known_version == game.version:
+        return GameStateForm(game_id = game_id, version = game.version, not_modified = True)
 
-      if state == "no_winners_yet":
-        print("\n\n No Winners Yet, Game Continues: {0} \n\n".format(game_id))
-        return StringMessage(message = "No Winners Yet, Game Continues: {0} "
-                             .format(game_id) )  
-        
+      return GuessANumberApi._game_state_form(game, state)
 
 
-      print("\n\n Game Won By: {0} \n\n".format(state))
-      return StringMessage(message = "Game Won By: {0} "
-                           .format(state) )  
-        
+    @endpoints.method(request_message = WAIT_FOR_MOVE_REQUEST, response_message = GameStateForm,
+                      path = "wait_for_move", name = "wait_for_move", http_method = "POST")
+    @instrumented
+    def wait_for_move(self, request):
+      """ Long poll for the next move in a game. Returns the game state as soon
+      as its version differs from known_version. Otherwise holds the request for
+      up to timeout seconds (20 by default, at most 50) and only sets
+      not_modified, with retry_after_ms suggesting when to call again. A timeout
+      of 0 answers at once. Waiting reads memcache only """
+      game_id = request.game_id
 
-    @endpoints.method(message_types.VoidMessage, response_message = StringMessage,
+      if game_id == None or request.known_version == None:
+        raise endpoints.BadRequestException("game_id and known_version are required")
+
+      if request.timeout < 0:
+        raise endpoints.BadRequestException("timeout must not be negative")
+
+      timeout = min(request.timeout, MAX_WAIT_TIMEOUT)
+      game = cache.wait_for_change(game_id, request.known_version, timeout)
+
+      if game == None:
+        raise endpoints.NotFoundException("Game doesnt exist for ID: {0}".format(game_id))
+
+      if game.version != request.known_version:
+        return GuessANumberApi._game_state_form(game, GuessANumberApi._check_game_state(game))
+
+      # An ended game won't change any more, there is nothing to poll for
+      if game.result() != board.ONGOING:
+        retry_after_ms = None
+      elif timeout > 0:
+        retry_after_ms = 0
+      else:
+        retry_after_ms = WAIT_RETRY_AFTER_MS
+
+      return GameStateForm(game_id = game_id, version = game.version, not_modified = True,
+                           retry_after_ms = retry_after_ms)
+
+
+    @endpoints.method(request_message = SHOW_GAME_IDS_REQUEST, response_message = GameIdForms,
                       path="show_game_ids", name="show_game_ids", http_method='GET')
+    @instrumented
     def show_game_ids(self, request):
+      """ Lists game ids one page at a time, optionally filtered by status
+      (active or finished) and player. Boards are only loaded and rendered when
+      include_board is set, otherwise this is a keys-only query. Legacy games
+      are listed once migrated """
+
+      page_size = min(request.page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+      query = Game.query()
+
+      if request.status == "active":
+        query = query.filter(Game.finished == False)
+      elif request.status == "finished":
+        query = query.filter(Game.finished == True)
+      elif request.status != None:
+        raise endpoints.BadRequestException("status must be active or finished")
+
+      if request.player != None:
+        query = query.filter(Game.players == request.player)
+
+      try:
+        cursor = Cursor(urlsafe = request.cursor) if request.cursor else None
+      except Exception:
+        raise endpoints.BadRequestException("Invalid cursor")
+
+      results, next_cursor, more = query.fetch_page(
+        page_size, start_cursor = cursor, keys_only = not request.include_board)
+
+      items = []
+      for result in results:
+        if not request.include_board:
+          if result.string_id():
+            items.append(GameIdForm(game_id = result.string_id()))
+        elif not result.is_legacy:
+          GuessANumberApi._show_game_picture(result)
+          items.append(GameIdForm(game_id = result.game_id, board = result.board,
+                                  state = GuessANumberApi._check_game_state(result)))
+
+      log.debug("listed game ids", count = len(items), more = more)
+      return GameIdForms(items = items, more = more,
+                         next_cursor = next_cursor.urlsafe() if more and next_cursor else None)
+
+
+    @endpoints.method(request_message = LEADERBOARD_REQUEST, response_message = PlayerStatsForms,
+                      path="leaderboard", name="get_leaderboard", http_method='GET')
+    @instrumented
+    def get_leaderboard(self, request):
+      """ Returns up to limit players with the most wins, best first. Served
+      from a cached top list, a game's result shows up a minute or two after
+      it ends """
+      if request.limit < 1:
+        raise endpoints.BadRequestException("limit must be positive")
+
+      limit = min(request.limit, leaderboard.LEADERBOARD_SIZE)
+      return PlayerStatsForms(items = [stats.to_form(rank) for rank, stats
+                                       in leaderboard.get_leaderboard(limit)])
+
+    @endpoints.method(request_message = USER_ID, response_message = PlayerStatsForm,
+                      path="user_ranking", name="get_user_ranking", http_method='GET')
+    @instrumented
+    def get_user_ranking(self, request):
+      """ Returns the wins, losses, draws and leaderboard rank of a player. The
+      rank is left out for players far down the leaderboard """
+      if request.user_id == None:
+        raise endpoints.BadRequestException("user_id is required")
+
+      rank, stats = leaderboard.get_ranking(request.user_id)
+
+      if stats == None:
+        raise endpoints.NotFoundException("No finished games for user: {0}".format(request.user_id))
+
+      return stats.to_form(rank)
+
+
+    @endpoints.method(message_types.VoidMessage, response_message = GameStatsForm,
+                      path="game_stats", name="get_game_stats", http_method='GET')
+    @instrumented
+    def get_game_stats(self, request):
+      """ Returns the number of games started, active and finished, the moves
+      played in finished games and the average moves per finished game, from
+      the snapshot cached by the /tasks/cache_average_attempts task """
+      return GameStatsForm(**game_stats.get_snapshot())
 
-      moves = Move.query().fetch()
-      game_ids = []
 
-      for move in moves:
-        game_id = move.game_id
+    @endpoints.method(message_types.VoidMessage, response_message = StringMessage,
+                      path="cache_stats", name="cache_stats", http_method='GET')
+    @instrumented
+    def getCacheStats(self, request):
+      """ Returns the hit and miss counters of the game state cache """
+      hits, misses = cache.get_stats()
+      return StringMessage(message = "Game state cache hits: {0}, misses: {1}".format(hits, misses))
 
-        if game_id not in game_ids:
-          game_ids.append(game_id)
 
-          #Showing game moves per game
-          GuessANumberApi._show_game_picture(game_id)
-          GuessANumberApi._check_game_state(game_id)          
+    @endpoints.method(message_types.VoidMessage, response_message = MetricsForms,
+                      path="metrics", name="get_metrics", http_method='GET')
+    def getMetrics(self, request):
+      """ Admin only. Returns latency percentiles, datastore RPCs, game state cache
+      hits and misses and response sizes over the recent calls of every endpoint """
+      GuessANumberApi._require_admin()
+      return MetricsForms(items = [MetricsForm(**summary) for summary in metrics.get_summary()])
 
 
-      print( "\n\n Total Game IDS: {0}, IDS: {1} \n\n".format( len(game_ids), str(game_ids) ) ) 
-      return StringMessage(message=  "Total Moves: {0}, Total Game IDS: {1}, IDS: {2}".format( len(moves), len(game_ids), str(game_ids) ) )
+    @staticmethod
+    @ndb.transactional(xg = True)
+    def _create_game(game_id, player1, player2, size, run_length, idempotency_key = None, message = None):
+      """ Creates the game and queues the task counting it as started in one
+      transaction, storing the startGame response, with message, under
+      idempotency_key if given. Returns None if a game already exists for
+      game_id """
 
+      game = Game.create(game_id, player1, player2, size, run_length)
+
+      if game != None:
+        game_stats.schedule_start(game_id)
+        if idempotency_key != None:
+          idempotency.save(game.key, "start_game", idempotency_key, game.to_form(message)).put()
+
+      return game
 
-    # @endpoints.method(request_message = START_GAME, response_message = StringMessage)
     @staticmethod
-    def _show_game_picture(game_id):
-
-      """ Print visual representation of game state """
-
-      moves = Move.query(Move.game_id == game_id).order(Move.x, Move.y).fetch()
-
-      if len(moves) == 0:
-        print("\n\nCant print game state, Invalid game_id {0}\n\n".format(game_id))
-        return StringMessage(message = "Invalid move parameters. no game found" )
-
-      player1,player2 = GuessANumberApi._get_players_in_game(game_id)
-
-      print("Current Players for Game ID {0}: {1}, {2}".format(game_id, player1, player2) )
-
-
-      m_00 = Move.query(Move.x == 0, Move.y == 0, 
-                        Move.game_id == game_id).fetch(1)[0]
-      m_01 = Move.query(Move.x == 0, Move.y == 1, 
-                        Move.game_id == game_id).fetch(1)[0] 
-      m_02 = Move.query(Move.x == 0, Move.y == 2, 
-                        Move.game_id == game_id).fetch(1)[0] 
-      m_10 = Move.query(Move.x == 1, Move.y == 0, 
-                        Move.game_id == game_id).fetch(1)[0] 
-      m_11 = Move.query(Move.x == 1, Move.y == 1, 
-                        Move.game_id == game_id).fetch(1)[0] 
-      m_12 = Move.query(Move.x == 1, Move.y == 2, 
-                        Move.game_id == game_id).fetch(1)[0] 
-      m_20 = Move.query(Move.x == 2, Move.y == 0, 
-                        Move.game_id == game_id).fetch(1)[0] 
-      m_21 = Move.query(Move.x == 2, Move.y == 1, 
-                        Move.game_id == game_id).fetch(1)[0] 
-      m_22 = Move.query(Move.x == 2, Move.y == 2, 
-                        Move.game_id == game_id).fetch(1)[0] 
-
-      m_00 = m_00.user_id or m_00.description
-      m_01 = m_01.user_id or m_01.description
-      m_02 = m_02.user_id or m_02.description
-      m_10 = m_10.user_id or m_10.description
-      m_11 = m_11.user_id or m_11.description
-      m_12 = m_12.user_id or m_12.description
-      m_20 = m_20.user_id or m_20.description
-      m_21 = m_21.user_id or m_21.description
-      m_22 = m_22.user_id or m_22.description
-
-      print("\n\n\n")
-      print("TIC TAC TOE GAME")
-      print("\n")
-      print(" {0} | {1} | {2} ".format(m_00, m_01, m_02))
-      print("-----------------------------")
-      print(" {0} | {1} | {2} ".format(m_10, m_11, m_12))
-      print("-----------------------------")
-      print(" {0} | {1} | {2} ".format(m_20, m_21, m_22))
-      print("\n\n\n")
+    def _check_idempotency_key(idempotency_key):
+      """ Raises BadRequestException when the idempotency key is too long to be
+      stored """
+
+      if idempotency_key != None and len(idempotency_key) > idempotency.MAX_KEY_LENGTH:
+        raise endpoints.BadRequestException(
+          "idempotency_key must be at most {0} characters".format(idempotency.MAX_KEY_LENGTH))
 
     @staticmethod
-    def _check_game_state(game_id):
-      """ Checks whether there's a victory condition, losing condition, or no more available moves """
+    def _create_matched_game(opponent_ticket_id, ticket):
+      """ Creates the game of the player waiting on opponent_ticket_id, as player1,
+      and the ticket's player, assigning it to both tickets in the same
+      transaction and telling the waiting player. Returns its game_id, None when
+      either ticket was already paired """
+
+      game_id = matchmaking.new_game_id()
+      ticket_ids = [opponent_ticket_id, ticket.key.id()]
+
+      @ndb.transactional(xg = True)
+      def create():
+        if not matchmaking.assign(ticket_ids, game_id):
+          return None
+        opponent_ticket = matchmaking.get_ticket(opponent_ticket_id)
+        return GuessANumberApi._create_game(game_id, opponent_ticket.user_id, ticket.user_id,
+                                            ticket.size, ticket.run_length)
+
+      try:
+        game = create()
+      except datastore_errors.TransactionFailedError:
+        # The caller checks whether its own ticket got paired meanwhile
+        log.warning("matchmaking pairing conflict", ticket = ticket_ids[1],
+                    opponent_ticket = opponent_ticket_id)
+        return None
 
-      print("\n\nInside check game state, game_id: " + game_id)
+      if game == None:
+        log.info("matchmaking ticket already paired", ticket = ticket_ids[1],
+                 opponent_ticket = opponent_ticket_id)
+        return None
 
-      moves = Move.query(Move.game_id == game_id).fetch()
-      available_moves = Move.query(Move.available == True, Move.game_id == game_id).fetch()
-      
-      if len(moves) == 0:
-        print("\n\n game_id not found {0} \n\n".format(game_id))
-        return "game_id_not_found"
+      matchmaking.notify(ticket_ids, game_id)
+      cache.set_game_async(game).get_result()
+      log.info("players matched", game_id = game_id, player1 = game.player1, player2 = game.player2)
 
-      winner_id = GuessANumberApi._check_winning_condition(game_id)
+      return game_id
 
-      if winner_id != False:
-        print("\n\n############### Game won by:" + winner_id + " ###############\n\n") 
-        return winner_id        
+    @staticmethod
+    def _check_board(size, run_length):
+      """ Returns why a size x size board won with run_length in a row can't be
+      played, None if it can """
 
-      if len(available_moves) == 0:
-        print("\n\n Game Ended, No more moves left {0} \n\n".format(game_id))
-        return "no_more_moves"
+      if size < MIN_BOARD_SIZE or size > MAX_BOARD_SIZE:
+        return "Board size must be between {0} and {1}".format(MIN_BOARD_SIZE, MAX_BOARD_SIZE)
 
-           
-      print("\n\nNo winners yet for game: {0} \n\n".format(game_id))
-      return "no_winners_yet"
+      if run_length < MIN_BOARD_SIZE or run_length > size:
+        return "Run length must be between {0} and the board size".format(MIN_BOARD_SIZE)
+
+      return None
+
+    @staticmethod
+    def _apply_move(context, user_id, x, y, idempotency_key = None):
+      """ Applies the move in a transaction on the game's entity group. Returns
+      (game, message), game is None when the move was rejected. Raises a
+      ConflictException when the game stays contended after all retries """
+
+      game_id = context.game_id
+
+      try:
+        game, results = GuessANumberApi._apply_moves_async(context, [(user_id, x, y)],
+                                                           idempotency_key).get_result()
+      except datastore_errors.TransactionFailedError:
+        log.warning("move conflict", game_id = game_id, user_id = user_id, x = x, y = y)
+        raise endpoints.ConflictException(CONFLICT_MESSAGE.format(game_id))
+
+      return game, results[0][1]
+
+    @staticmethod
+    @ndb.tasklet
+    def _apply_moves_async(context, moves, idempotency_key = None):
+      """ Tasklet applying moves, a list of (user_id, x, y), to the context's game
+      in order and in a single transaction, then writing the game through to the
+      cache. Returns (game, [(applied, message), ...]), game is None when no move
+      was applied. Raises TransactionFailedError when the game stays contended
+      after all retries """
+
+      game_id = context.game_id
+      game, results = yield GuessANumberApi._apply_moves_transaction_async(game_id, moves, idempotency_key)
+
+      if game == None and results[0][1] == WRONG_GAME_ID:
+        existing = yield context.get_game_async()
+        if existing != None:
+          # Legacy game, the lookup just saved it again under its game_id
+          game, results = yield GuessANumberApi._apply_moves_transaction_async(game_id, moves,
+                                                                               idempotency_key)
+
+      if game != None:
+        context.saved(game)
+        yield cache.set_game_async(game)
+
+      raise ndb.Return((game, results))
 
-      
+    @staticmethod
+    @ndb.transactional_tasklet(retries = MOVE_TRANSACTION_RETRIES)
+    def _apply_moves_transaction_async(game_id, moves, idempotency_key = None):
+      """ Validates and applies the moves reading and writing only the Game
+      entity, once, so concurrent moves on the same game conflict and get
+      retried. With an idempotency_key the makeMove response of the last move is
+      stored along, and nothing is applied if one already was """
+
+      game = stored = None
+      if game_id:
+        game_key = Game.key_for(game_id)
+        game, stored = yield (game_key.get_async(),
+                              idempotency.get_stored_async(game_key, "make_move", idempotency_key, GameStateForm))
 
-      
+      if game == None :
+        log.debug("move rejected, wrong game id", game_id = game_id)
+        raise ndb.Return((None, [(False, WRONG_GAME_ID)] * len(moves)))
+
+      if stored != None:
+        log.debug("move already applied", game_id = game_id, idempotency_key = idempotency_key)
+        raise ndb.Return((None, [(False, DUPLICATE_REQUEST)] * len(moves)))
+
+      events = []
+      results = []
+      ended = game.result() != board.ONGOING
+      for user_id, x, y in moves:
+        event, message = GuessANumberApi._play_move(game, user_id, x, y)
+        if event != None:
+          events.append(event)
+        results.append((event != None, message))
+
+      if not events:
+        raise ndb.Return((None, results))
+
+      if not ended and game.result() != board.ONGOING:
+        leaderboard.schedule_result(game_id)
+
+      # The move log entries and the stored response share the game's entity
+      # group, so they are committed together with the board
+      entities = [game] + events
+      if idempotency_key != None:
+        entities.append(idempotency.save(game_key, "make_move", idempotency_key,
+                                         game.to_form(results[-1][1])))
+      yield ndb.put_multi_async(entities)
+      raise ndb.Return((game, results))
 
     @staticmethod
-    def _check_winning_condition(game_id):
-      """ Checks whether there's a victory condition and returns winner user_id if there is, else false"""
+    def _play_move(game, user_id, x, y):
+      """ Validates a move and plays it on the in memory game. Returns
+      (event, message), event is the unsaved MoveEvent or None when the move is
+      rejected """
 
-      # Find game with only 2 allowed users, to be done...
-      moves = Move.query(Move.game_id == game_id).fetch()
-      user_ids = GuessANumberApi._get_players_in_game(game_id)
+      game_id = game.game_id
+      state = GuessANumberApi._check_game_state(game)
 
-      if len(moves) == 0:
-        print("\n\n game_id not found {0} \n\n".format(game_id))
-        return False
-        return "game_id not found"
-      if None in user_ids:
-        print("\n\n not all users have played a move: {0} \n\n".format(user_ids))
-        return False
-        return "not all users have played a move"
+      if state not in ("no_winners_yet", "no_more_moves"):
+        log.debug("move rejected, game won", game_id = game_id, winner_id = state)
+        return None, "\n\n Game Won By {0} \n\n".format(state)
 
-      print("\n\nChecking winning condition for game id: " + game_id)
+      if state == "no_more_moves":
+        log.debug("move rejected, no moves left", game_id = game_id)
+        return None, "Game Ended, No more moves left {0}".format(game_id)
 
-      user_1 = user_ids[0]
-      user_2 = user_ids[1]
+      if user_id == None or user_id not in [game.player1, game.player2]:
+        log.debug("move rejected, wrong user id", game_id = game_id, user_id = user_id)
+        return None, "Invalid Move, Wrong User ID"
 
-      for i in range(0,3):
+      if x == None or y == None or not game.contains(x, y):
+        log.debug("move rejected, out of range", game_id = game_id, x = x, y = y)
+        return None, "Invalid move parameters, Wrong Game ID or Move out of range"
 
-        # Checking for Horizontal Wins
-        horizontal_moves = Move.query(Move.game_id == game_id, Move.x == i) 
-        horizontal_moves = [h.user_id for h in horizontal_moves]
+      if user_id == game.last_play_user_id:
+        log.debug("move rejected, player already moved", game_id = game_id, user_id = user_id)
+        return None, "Invalid move, This Player already moved"
 
-        unique_owner = list( set(horizontal_moves) ) 
+      description = "[{0},{1}]".format(x, y)
+      if not game.is_available(x, y):
+        owner_id = game.owner_of(x, y)
+        log.debug("move rejected, cell taken", game_id = game_id, x = x, y = y, owner_id = owner_id)
+        return None, "Move {0} has already been made by User with ID: : {1}".format(description, owner_id)
 
-        if None not in unique_owner and len(unique_owner) == 1:
-          winner_id = unique_owner[0] 
-          print("\n\nHorizontal Winning condition met, User: {0} Won! Row: {1} \n\n".format(winner_id, i))
-          return winner_id     
+      event = game.play(x, y, user_id)
 
-        # Checking for Vertical Wins
-        vertical_moves = Move.query(Move.game_id == game_id, Move.y == i) 
-        vertical_moves = [h.user_id for h in vertical_moves]  
+      return event, "Move {0} assign to {1} for game_id: {2}, x:{3} and y:{4}".format(description, user_id, game_id, x, y)
 
-        unique_owner = list( set(vertical_moves) )                
+    @staticmethod
+    @ndb.tasklet
+    def _undo_move_async(context, user_id):
+      """ Tasklet taking back the last move of the context's game in a transaction,
+      then writing the game through to the cache. Returns (game, event), (None,
+      None) if the game doesn't exist. Raises ValueError when the move can't be
+      undone and TransactionFailedError when the game stays contended """
 
-        if None not in unique_owner and len(unique_owner) == 1:
-          winner_id = unique_owner[0] 
-          print("\n\n Vertical Winning condition met, User: {0} Won!, Column: {1} \n\n".format(winner_id, i))
-          return winner_id            
+      game_id = context.game_id
 
-      # Checking Cross Wins
-      diagonal_moves = []
-      for i in range(0,3):
-        m = Move.query(Move.x == i, Move.y == i).fetch()[0]
+      if not game_id:
+        raise ndb.Return((None, None))
 
-      unique_owner = list(set(diagonal_moves))
+      game, event = yield GuessANumberApi._undo_move_transaction_async(game_id, user_id)
 
-      if None not in unique_owner and len(unique_owner) == 1:
-        winner_id = unique_owner[0] 
-        print("\n\n Diagonal Winning condition met, User: {0} Won!, Column: {1} \n\n".format(winner_id, i))
-        return winner_id   
+      if game == None:
+        existing = yield context.get_game_async()
+        if existing != None:
+          # Legacy game, the lookup just saved it again under its game_id
+          game, event = yield GuessANumberApi._undo_move_transaction_async(game_id, user_id)
 
-      # Checking Cross Wins
+      if game != None:
+        context.saved(game)
+        yield cache.set_game_async(game)
 
-      diagonal_moves = []
-      for i in range(0,3):
-        m = Move.query(Move.x == i, Move.y == 2-i).fetch()[0]
-        diagonal_moves.append(m.user_id)
-        diagonal_moves.append(m.user_id)       
+      raise ndb.Return((game, event))
 
-      unique_owner = list(set(diagonal_moves))
+    @staticmethod
+    @ndb.transactional_tasklet(retries = MOVE_TRANSACTION_RETRIES)
+    def _undo_move_transaction_async(game_id, user_id):
+      """ Reads the game and its move log in its entity group, takes back the
+      last move and saves the game with the UNDO entry. Returns (game, event),
+      (None, None) if the game is not found under its key. Raises ValueError
+      when the move can't be undone """
 
-      if None not in unique_owner and len(unique_owner) == 1:
-        winner_id = unique_owner[0] 
-        print("\n\n Diagonal Winning condition met, User: {0} Won!, Column: {1} \n\n".format(winner_id, i))
-        return winner_id  
+      game_key = Game.key_for(game_id)
+      game, events = yield (game_key.get_async(),
+                            MoveEvent.history_query(game_key).fetch_async(MAX_MOVE_EVENTS))
 
-      print("\n\n No winning conditions met \n\n")
-      return False                
+      if game == None:
+        raise ndb.Return((None, None))
 
+      event = game.undo(user_id, events)
+      yield ndb.put_multi_async([game, event])
+      raise ndb.Return((game, event))
 
     @staticmethod
-    def _get_players_in_game(game_id):
+    @ndb.tasklet
+    def _delete_games_async(game_keys):
+      """ Tasklet deleting the games and everything stored in their entity
+      groups, found with one keys-only ancestor query per game, and dropping
+      them from the cache. Games deleted before they ended are counted as
+      abandoned once counted as started. Returns the number of entities deleted
+      besides the games """
+
+      game_ids = [key.string_id() for key in game_keys if key.string_id()]
+      games, group_keys = yield (
+        ndb.get_multi_async(game_keys),
+        # The game itself, its move log and stored responses
+        [ndb.Query(ancestor = key).fetch_async(MAX_GAME_CHILDREN + 1, keys_only = True)
+         for key in game_keys])
+      child_keys = [key for keys in group_keys for key in keys if key.parent() != None]
+
+      futures = ndb.delete_multi_async(list(game_keys) + child_keys)
+      futures.append(cache.delete_games_async(game_ids))
+      futures.append(idempotency.delete_cached_async(child_keys))
+
+      # Games whose start task hasn't run yet were never counted as started
+      abandoned = len([game for game in games
+                       if game != None and game.start_recorded and game.board != None
+                       and game.result() == board.ONGOING])
+      if abandoned:
+        futures.append(game_stats.record_abandoned_async(abandoned))
+      yield futures
+
+      raise ndb.Return(len(child_keys))
 
-      moves = Move.query(Move.game_id == game_id).fetch()
+    @staticmethod
+    def _require_admin():
+      """ Raises UnauthorizedException unless the caller is an admin of the app """
+      try:
+        is_admin = oauth.is_current_user_admin(endpoints.EMAIL_SCOPE)
+      except oauth.Error:
+        is_admin = False
 
-      if len(moves) == 0:
-        return StringMessage(message = "Invalid move parameters. no game found" )
+      if not is_admin:
+        raise endpoints.UnauthorizedException("Only admins can call this endpoint")
 
+    @staticmethod
+    @ndb.tasklet
+    def _get_game_state_async(context):
+      """ Tasklet returning (game, state) of the context's game, state as
+      returned by _check_game_state. (None, None) if the game doesn't exist """
 
-      print("Getting players in game...")
-      user_ids = []
+      game = yield context.get_game_async()
 
-      for move in moves:
-        user_id = move.user_id
-        # print("checking for ID: {0}".format( user_id) )
+      if game == None:
+        raise ndb.Return((None, None))
+
+      raise ndb.Return((game, GuessANumberApi._check_game_state(game)))
 
-        if user_id not in user_ids and user_id != None:
-          # print("ID: {0} was inserted".format( user_id) )
+    # @endpoints.method(request_message = START_GAME, response_message = StringMessage)
+    @staticmethod
+    def _show_game_picture(game):
+
+      """ Logs a visual representation of game state, only when debug logging
+      is enabled so the default path does no rendering at all """
+
+      if not log.is_debug():
+        return
+
+      player1,player2 = GuessANumberApi._get_players_in_game(game)
+
+      rows = []
+      for x in range(game.size):
+        cells = [game.owner_of(x, y) or "[{0},{1}]".format(x, y) for y in range(game.size)]
+        rows.append(" " + " | ".join(cells) + " ")
+
+      log.debug("TIC TAC TOE GAME\n" + "\n-----------------------------\n".join(rows),
+                game_id = game.game_id, player1 = player1, player2 = player2)
+
+    @staticmethod
+    def _check_game_state(game):
+      """ Checks whether there's a victory condition, losing condition, or no more available moves """
+
+      result = game.result()
+
+      if result in (board.PLAYER1_WINS, board.PLAYER2_WINS):
+        winner_id = game.winner_id()
+        log.sampled_debug(STATE_LOG_SAMPLE_RATE, "game won", game_id = game.game_id, winner_id = winner_id)
+        return winner_id        
+
+      if result == board.DRAW:
+        log.sampled_debug(STATE_LOG_SAMPLE_RATE, "game ended, no winners", game_id = game.game_id)
+        return "no_more_moves"
+
+           
+      log.sampled_debug(STATE_LOG_SAMPLE_RATE, "no winners yet", game_id = game.game_id)
+      return "no_winners_yet"
+
+
+    @staticmethod
+    def _game_state_form(game, state):
+      """ Returns the GameStateForm of game, state as returned by _check_game_state """
+
+      if state == "no_more_moves":
+        return game.to_form("Game Ended, No Winners: {0} "
+                            .format(game.game_id) )
+
+      if state == "no_winners_yet":
+        return game.to_form("No Winners Yet, Game Continues: {0} "
+                            .format(game.game_id) )
+
+      return game.to_form("Game Won By: {0} "
+                          .format(state) )
+
+    @staticmethod
+    def _get_players_in_game(game):
+      """ Returns [player1, player2] for the players who already own a cell, None otherwise """
+
+      user_ids = []
+
+      for user_id in [game.player1, game.player2]:
+        if game.marker_for(user_id) in game.board:
           user_ids.append(user_id)
 
-      print(user_ids)
       if len(user_ids) == 2:
         player1 = user_ids[0]
         player2 = user_ids[1]
@@ -437,10 +991,8 @@ class GuessANumberApi(remote.Service):
       else:
         player1 = None
         player2 = None                 
-        
-      print(player2, player1) 
-      return [player1, player2]     
 
+      return [player1, player2]     
 
 
 
@@ -557,17 +1109,5 @@ class GuessANumberApi(remote.Service):
     #     """Get the cached average moves remaining"""
     #     return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
 
-    @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                        for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
-
 
 api = endpoints.api_server([GuessANumberApi])
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Plays full games through GuessANumberApi against the App
+Engine testbed stubs (datastore_v3, memcache, taskqueue), with no network.
+
+Each game is startGame, then makeMove until the game ends with a
+checkGameState poll after every move, sending the version makeMove returned
+as a client holding the latest state would, and a wait_for_move from the
+opponent holding the version before the move. --size and --run-length play
+the games on larger boards, a move should cost about the same whatever the
+size. Per endpoint throughput, p50/p99
+latency and datastore RPCs per call are written as JSON, so runs before and
+after a change can be compared. A contention round also fires simultaneous
+moves at the same cell and checks exactly one of them is applied, and a
+matchmaking round has --joiners players join at once and checks each one
+ends up in exactly one game. Requests sent twice with the same idempotency
+key must get the same response and change the game once.
+
+Every endpoint call of the games is a request of its own, ending with the
+ndb context cache cleared, and may use at most MAX_DATASTORE_RPCS datastore
+RPCs, so a helper reading the game once more than it needs to fails the run.
+
+The datastore stub requires indexes, and an index audit calls every endpoint
+and task handler that runs a query, so a query with no matching index in
+index.yaml fails the run.
+
+    python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --games 2000 --output before.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Datastore RPCs an endpoint call of the games may use: a move is one
+# transaction reading and writing the game, polls are served from memcache
+# and read the game at most once on a miss
+MAX_DATASTORE_RPCS = {
+    # Begin, get game, put game, AddActions for the start task, commit
+    'startGame': 5,
+    # Begin, get game, put game and move log entry, commit, and AddActions
+    # for the result task queued by the move ending the game
+    'makeMove': 5,
+    'checkGameState': 1,
+    'wait_for_move': 1,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', help='Path of the App Engine Python SDK, '
+                        'when it is not already importable')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--contention', type=int, default=8,
+                        help='Simultaneous moves fired at each cell')
+    parser.add_argument('--joiners', type=int, default=1000,
+                        help='Players joining matchmaking simultaneously')
+    parser.add_argument('--size', type=int, default=3,
+                        help='Board size of the played games')
+    parser.add_argument('--run-length', type=int,
+                        help='Marks in a row needed to win, five at most by '
+                        'default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    return parser.parse_args()
+
+
+def setup_sdk(sdk):
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+
+def start_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # Endpoints reads the app revision from the minor part of the version id,
+    # which testbed's default version id doesn't have
+    bed.setup_env(app_id='udacitygamedesign', current_version_id='v1.1',
+                  overwrite=True)
+    # Fully consistent, like the reads the handlers rely on
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy,
+                               require_indexes=True, root_path=APP_DIR)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    return bed
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    rank = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+class Recorder(object):
+    """Collects the samples metrics records for every endpoint call, and ends
+    the call's request by clearing the ndb context cache, which a real request
+    would not share with the next one"""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, name, sample):
+        from google.appengine.ext import ndb
+        with self.lock:
+            self.samples.setdefault(name, []).append(sample)
+        ndb.get_context().clear_cache()
+
+    def report(self):
+        import metrics
+        report = {}
+        for name, samples in sorted(self.samples.items()):
+            wall_ms = [sample[metrics.WALL_MS] for sample in samples]
+            rpcs = [sample[metrics.DATASTORE_RPCS] for sample in samples]
+            report[name] = {
+                'calls': len(samples),
+                'calls_per_second': len(samples) / max(sum(wall_ms) / 1000.0,
+                                                       1e-9),
+                'p50_ms': percentile(wall_ms, 50),
+                'p99_ms': percentile(wall_ms, 99),
+                'avg_datastore_rpcs': float(sum(rpcs)) / len(samples),
+                'max_datastore_rpcs': max(rpcs),
+                'memcache_hits': sum(sample[metrics.MEMCACHE_HITS]
+                                     for sample in samples),
+                'memcache_misses': sum(sample[metrics.MEMCACHE_MISSES]
+                                       for sample in samples),
+                'errors': sum(sample[metrics.ERROR] for sample in samples),
+                'avg_response_bytes': float(sum(
+                    sample[metrics.RESPONSE_BYTES]
+                    for sample in samples)) / len(samples),
+            }
+        return report
+
+
+def play_game(service, game_id, rng, size, run_length):
+    from api import START_GAME, GAME_STATE_REQUEST, MAKE_NEXT_MOVE_REQUEST,\
+        WAIT_FOR_MOVE_REQUEST
+    from models import GameStatus
+
+    players = ['{0}-a'.format(game_id), '{0}-b'.format(game_id)]
+    state = service.startGame(START_GAME.combined_message_class(
+        game_id=game_id, player1=players[0], player2=players[1], size=size,
+        run_length=run_length))
+
+    free = list(range(size * size))
+    rng.shuffle(free)
+    turn = rng.randint(0, 1)
+    while state.status == GameStatus.ACTIVE:
+        x, y = divmod(free.pop(), size)
+        known_version = state.version
+        state = service.makeMove(MAKE_NEXT_MOVE_REQUEST.combined_message_class(
+            game_id=game_id, user_id=players[turn], x=x, y=y))
+        service.checkGameState(GAME_STATE_REQUEST.combined_message_class(
+            game_id=game_id, known_version=state.version))
+        service.wait_for_move(WAIT_FOR_MOVE_REQUEST.combined_message_class(
+            game_id=game_id, known_version=known_version, timeout=0))
+        turn = 1 - turn
+
+
+def run_contention(service_class, moves_per_cell):
+    """Fires moves_per_cell simultaneous makeMove calls, from both players, at
+    each cell of a fresh game. Returns the number of cells where the count of
+    applied moves was not exactly one"""
+    import endpoints
+    import board
+    from api import START_GAME, MAKE_NEXT_MOVE_REQUEST
+    from models import Game
+
+    failures = 0
+    for i in range(board.BOARD_SIZE * board.BOARD_SIZE):
+        game_id = 'contention-{0}'.format(i)
+        players = ['{0}-a'.format(game_id), '{0}-b'.format(game_id)]
+        service_class().startGame(START_GAME.combined_message_class(
+            game_id=game_id, player1=players[0], player2=players[1]))
+        x, y = divmod(i, board.BOARD_SIZE)
+        applied = []
+
+        def move(user_id):
+            try:
+                response = service_class().makeMove(
+                    MAKE_NEXT_MOVE_REQUEST.combined_message_class(
+                        game_id=game_id, user_id=user_id, x=x, y=y))
+            except endpoints.ConflictException:
+                return
+            if ' assign to ' in response.message:
+                applied.append(user_id)
+
+        threads = [threading.Thread(target=move, args=(players[n % 2],))
+                   for n in range(moves_per_cell)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        game = Game.key_for(game_id).get(use_cache=False, use_memcache=False)
+        if len(applied) != 1 or game.move_count != 1:
+            failures += 1
+    return failures
+
+
+def run_matchmaking(service_class, joiners):
+    """Has joiners players call join_matchmaking at the same time, rejoining
+    with their ticket until they are matched. Returns (players in more than
+    one game, players in no game)"""
+    import collections
+    from api import JOIN_MATCHMAKING_REQUEST
+    from models import Game
+
+    assigned = {}
+
+    def join(user_id):
+        ticket = None
+        for _ in range(3):
+            response = service_class().join_matchmaking(
+                JOIN_MATCHMAKING_REQUEST.combined_message_class(
+                    user_id=user_id, ticket=ticket))
+            if response.matched:
+                assigned[user_id] = response.game
+                return
+            ticket = response.ticket
+
+    user_ids = ['joiner-{0}'.format(n) for n in range(joiners)]
+    threads = [threading.Thread(target=join, args=(user_id,))
+               for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    games = collections.Counter()
+    for game in Game.query().fetch():
+        if game.game_id.startswith('match-'):
+            games.update(game.players)
+    duplicates = [user_id for user_id in user_ids if games[user_id] > 1]
+    unmatched = [user_id for user_id in user_ids if not games[user_id] or
+                 user_id not in assigned or
+                 user_id not in (assigned[user_id].player1,
+                                 assigned[user_id].player2)]
+    # An odd player out has nobody left to play
+    if joiners % 2 and len(unmatched) == 1:
+        unmatched = []
+    return duplicates, unmatched
+
+
+def run_retries(service_class):
+    """Sends startGame and makeMove twice each with the same idempotency
+    key, as a client retrying after a timeout would, then resets the game and
+    starts it again with the same key. Returns the names of the calls whose
+    retry did not get the first response back or changed the game again, or
+    whose key outlived the game"""
+    from api import START_GAME, MAKE_NEXT_MOVE_REQUEST, GAME_ID
+    from models import Game
+
+    game_id = 'retried'
+    start = START_GAME.combined_message_class(
+        game_id=game_id, player1='retried-a', player2='retried-b',
+        idempotency_key='start-1')
+    move = MAKE_NEXT_MOVE_REQUEST.combined_message_class(
+        game_id=game_id, user_id='retried-a', x=0, y=0,
+        idempotency_key='move-1')
+
+    service = service_class()
+    failures = []
+    if service.startGame(start) != service.startGame(start):
+        failures.append('startGame')
+    first = service.makeMove(move)
+    retry = service.makeMove(move)
+    game = Game.key_for(game_id).get(use_cache=False)
+    if retry != first or game.move_count != 1:
+        failures.append('makeMove')
+
+    service.resetGameState(GAME_ID.combined_message_class(game_id=game_id))
+    service.startGame(start)
+    game = Game.key_for(game_id).get(use_cache=False)
+    if game is None or game.move_count != 0:
+        failures.append('startGame after resetGameState')
+    return failures
+
+
+def run_index_audit():
+    """Calls every endpoint and task handler issuing a datastore query.
+    Returns the names of the calls that needed an index missing from
+    index.yaml"""
+    import datetime
+    import webapp2
+    from google.appengine.api import datastore_errors
+    import api
+    import leaderboard
+    import main
+    from models import User
+
+    service = api.GuessANumberApi()
+    players = ['audit-a', 'audit-b']
+    for game_id in ('audit', 'audit-open'):
+        service.startGame(api.START_GAME.combined_message_class(
+            game_id=game_id, player1=players[0], player2=players[1]))
+    for n, (x, y) in enumerate([(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)]):
+        service.makeMove(api.MAKE_NEXT_MOVE_REQUEST.combined_message_class(
+            game_id='audit', user_id=players[n % 2], x=x, y=y))
+    User(name=players[0], email='audit-a@example.com').put()
+
+    tomorrow = (datetime.datetime.utcnow() + datetime.timedelta(days=1))\
+        .strftime(api.PURGE_CUTOFF_FORMAT)
+
+    def post(path, **params):
+        response = webapp2.Request.blank(path, POST=params).get_response(
+            main.app)
+        assert response.status_int == 204, response.status
+
+    def show_game_ids(status, player):
+        service.show_game_ids(api.SHOW_GAME_IDS_REQUEST.combined_message_class(
+            status=status, player=player, include_board=True))
+
+    calls = [('show_game_ids status={0} player={1}'.format(status, player),
+              lambda status=status, player=player: show_game_ids(status,
+                                                                 player))
+             for status in (None, 'active', 'finished')
+             for player in (None, players[0])]
+    calls += [
+        ('checkGameState unknown game', lambda: service.checkGameState(
+            api.GAME_STATE_REQUEST.combined_message_class(
+                game_id='audit-missing'))),
+        ('game_history', lambda: service.game_history(
+            api.GAME_ID.combined_message_class(game_id='audit'))),
+        ('undo_move', lambda: service.undo_move(
+            api.UNDO_MOVE_REQUEST.combined_message_class(
+                game_id='audit', user_id=players[0]))),
+        ('record_result', lambda: post('/tasks/record_result',
+                                       game_id='audit')),
+        ('fold_player_stats', lambda: [leaderboard.fold(user_id)
+                                       for user_id in players]),
+        ('get_leaderboard', lambda: service.get_leaderboard(
+            api.LEADERBOARD_REQUEST.combined_message_class())),
+        ('get_user_ranking', lambda: service.get_user_ranking(
+            api.USER_ID.combined_message_class(user_id=players[1]))),
+        ('get_game_stats', lambda: service.get_game_stats(
+            api.message_types.VoidMessage())),
+        ('send_reminders', lambda: post('/tasks/send_reminders', day='audit',
+                                        cutoff=tomorrow)),
+        ('send_reminder_batch', lambda: post('/tasks/send_reminder_batch',
+                                             day='audit', user_id=players[0])),
+        ('migrate_boards', lambda: post('/tasks/migrate_boards')),
+        ('resetGameState', lambda: service.resetGameState(
+            api.GAME_ID.combined_message_class(game_id='audit-open'))),
+        ('purge_games', lambda: post('/tasks/purge_games', cutoff=tomorrow)),
+    ]
+
+    missing = []
+    for name, call in calls:
+        try:
+            call()
+        except datastore_errors.NeedIndexError as error:
+            print('{0}: {1}'.format(name, error))
+            missing.append(name)
+    return missing
+
+
+def main():
+    args = parse_args()
+    setup_sdk(args.sdk)
+    bed = start_testbed()
+    try:
+        import metrics
+        from api import GuessANumberApi
+
+        recorder = Recorder()
+        metrics.LISTENERS.append(recorder)
+        rng = random.Random(args.seed)
+        service = GuessANumberApi()
+
+        started = time.time()
+        for n in range(args.games):
+            play_game(service, 'bench-{0}'.format(n), rng, args.size,
+                      args.run_length)
+        elapsed = time.time() - started
+        metrics.LISTENERS.remove(recorder)
+        report = recorder.report()
+        over_rpc_bound = dict(
+            (name, report[name]['max_datastore_rpcs'])
+            for name, bound in MAX_DATASTORE_RPCS.items()
+            if name in report and report[name]['max_datastore_rpcs'] > bound)
+
+        contention_failures = run_contention(GuessANumberApi, args.contention)
+        duplicate_pairings, unmatched = run_matchmaking(GuessANumberApi,
+                                                        args.joiners)
+        retry_failures = run_retries(GuessANumberApi)
+        missing_indexes = run_index_audit()
+
+        result = {
+            'games': args.games,
+            'size': args.size,
+            'seed': args.seed,
+            'seconds': elapsed,
+            'games_per_second': args.games / elapsed,
+            'endpoints': report,
+            'endpoints_over_rpc_bound': over_rpc_bound,
+            'contention': {
+                'moves_per_cell': args.contention,
+                'cells_not_applied_exactly_once': contention_failures,
+            },
+            'matchmaking': {
+                'joiners': args.joiners,
+                'players_paired_more_than_once': len(duplicate_pairings),
+                'players_not_paired': len(unmatched),
+            },
+            'retries_not_idempotent': retry_failures,
+            'queries_missing_an_index': missing_indexes,
+        }
+    finally:
+        bed.deactivate()
+
+    with open(args.output, 'w') as output:
+        json.dump(result, output, indent=2, sort_keys=True)
+    print('{0} games in {1:.1f}s, {2:.1f} games/s, results in {3}'.format(
+        args.games, elapsed, result['games_per_second'], args.output))
+    if contention_failures:
+        print('{0} cells did not apply exactly one of the simultaneous '
+              'moves'.format(contention_failures))
+    for name, rpcs in sorted(over_rpc_bound.items()):
+        print('{0} used {1} datastore RPCs, at most {2} expected'.format(
+            name, rpcs, MAX_DATASTORE_RPCS[name]))
+    if duplicate_pairings or unmatched:
+        print('{0} players paired more than once, {1} not paired'.format(
+            len(duplicate_pairings), len(unmatched)))
+    if retry_failures:
+        print('Retried calls were not idempotent: {0}'.format(
+            ', '.join(retry_failures)))
+    if missing_indexes:
+        print('{0} calls ran queries missing from index.yaml'.format(
+            len(missing_indexes)))
+    if (over_rpc_bound or contention_failures or duplicate_pairings or
+            unmatched or retry_failures or missing_indexes):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
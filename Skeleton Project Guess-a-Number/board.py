@@ -0,0 +1,133 @@
+"""board.py - Pure in-memory board evaluation for N x N, k in a row games.
+
+The board is packed row by row into a string of size * size characters, one
+per cell. After a move only the 4 lines through the cell just played are
+walked, at most run_length - 1 cells each way, so the cost of a move stays the
+same as boards grow. A board whose last move is unknown can be evaluated in
+full; the classic 3 x 3 board is then turned into two 9-bit masks, one per
+player, checked against the 8 precomputed winning lines with a bitwise AND.
+Nothing in here touches the datastore."""
+
+# Size and run length of the classic game, also used by the computer opponent
+BOARD_SIZE = 3
+MIN_BOARD_SIZE = 3
+MAX_BOARD_SIZE = 19
+# Run length of new games on larger boards, five in a row
+MAX_DEFAULT_RUN_LENGTH = 5
+EMPTY_CELL = '-'
+PLAYER1_CELL = 'X'
+PLAYER2_CELL = 'O'
+EMPTY_BOARD = EMPTY_CELL * (BOARD_SIZE * BOARD_SIZE)
+
+ONGOING = 'ongoing'
+DRAW = 'draw'
+PLAYER1_WINS = 'player1_wins'
+PLAYER2_WINS = 'player2_wins'
+
+
+# Steps along a row, a column and both diagonals
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+def cell_index(x, y, size=BOARD_SIZE):
+    """Position of the [x,y] cell inside the packed board string"""
+    return x * size + y
+
+
+def empty_board(size=BOARD_SIZE):
+    return EMPTY_CELL * (size * size)
+
+
+def default_run_length(size):
+    return min(size, MAX_DEFAULT_RUN_LENGTH)
+
+
+def _line_mask(cells):
+    mask = 0
+    for x, y in cells:
+        mask |= 1 << cell_index(x, y)
+    return mask
+
+
+def _winning_lines():
+    lines = []
+    for i in range(BOARD_SIZE):
+        lines.append([(i, j) for j in range(BOARD_SIZE)])
+        lines.append([(j, i) for j in range(BOARD_SIZE)])
+    lines.append([(i, i) for i in range(BOARD_SIZE)])
+    lines.append([(i, BOARD_SIZE - 1 - i) for i in range(BOARD_SIZE)])
+    return lines
+
+
+WIN_MASKS = tuple(_line_mask(line) for line in _winning_lines())
+FULL_MASK = (1 << (BOARD_SIZE * BOARD_SIZE)) - 1
+
+
+def to_masks(board):
+    """Splits a packed board string into (player1_mask, player2_mask)"""
+    player1_mask = 0
+    player2_mask = 0
+    for i, cell in enumerate(board):
+        if cell == PLAYER1_CELL:
+            player1_mask |= 1 << i
+        elif cell == PLAYER2_CELL:
+            player2_mask |= 1 << i
+    return player1_mask, player2_mask
+
+
+def evaluate(player1_mask, player2_mask):
+    """Returns PLAYER1_WINS, PLAYER2_WINS, DRAW or ONGOING for the board"""
+    for mask in WIN_MASKS:
+        if player1_mask & mask == mask:
+            return PLAYER1_WINS
+        if player2_mask & mask == mask:
+            return PLAYER2_WINS
+    if player1_mask | player2_mask == FULL_MASK:
+        return DRAW
+    return ONGOING
+
+
+def wins_at(cells, size, run_length, x, y):
+    """True if the marker on [x,y] is part of run_length or more in a row.
+    Only the 4 lines through the cell are walked, and at most run_length - 1
+    cells each way on each of them"""
+    marker = cells[cell_index(x, y, size)]
+    if marker == EMPTY_CELL:
+        return False
+    for dx, dy in DIRECTIONS:
+        run = 1
+        for step in (1, -1):
+            cx, cy = x + step * dx, y + step * dy
+            while (run < run_length and 0 <= cx < size and 0 <= cy < size and
+                   cells[cell_index(cx, cy, size)] == marker):
+                run += 1
+                cx, cy = cx + step * dx, cy + step * dy
+        if run >= run_length:
+            return True
+    return False
+
+
+def result_after(cells, size, run_length, x, y, move_count):
+    """Result of an ongoing game once [x,y] is played, move_count counting
+    that move. Looks at the lines through [x,y] only"""
+    if wins_at(cells, size, run_length, x, y):
+        if cells[cell_index(x, y, size)] == PLAYER1_CELL:
+            return PLAYER1_WINS
+        return PLAYER2_WINS
+    if move_count >= size * size:
+        return DRAW
+    return ONGOING
+
+
+def evaluate_cells(cells, size=BOARD_SIZE, run_length=BOARD_SIZE):
+    """Full evaluation of a board whose last move is unknown. Returns
+    PLAYER1_WINS, PLAYER2_WINS, DRAW or ONGOING"""
+    if size == BOARD_SIZE and run_length == BOARD_SIZE:
+        return evaluate(*to_masks(cells))
+    for i, cell in enumerate(cells):
+        if cell != EMPTY_CELL and wins_at(cells, size, run_length,
+                                          *divmod(i, size)):
+            return PLAYER1_WINS if cell == PLAYER1_CELL else PLAYER2_WINS
+    if EMPTY_CELL not in cells:
+        return DRAW
+    return ONGOING
@@ -0,0 +1,167 @@
+"""cache.py - Memcache read-through cache of game state.
+
+A game changes only a handful of times in its life, so the state clients poll
+for (board, turn and result) is served from memcache and only read from the
+datastore on a miss. Writers update the entry with compare-and-set so a slow
+request can never replace a newer board with an older one, the game's version
+tells which is newer since an undo lowers the move count. Long polls wait for
+a game to change by reading its entry with a backoff, so a waiting client
+costs memcache reads only. Hits and misses are counted per instance and
+added to the totals in memcache every STATS_FLUSH_INTERVAL seconds, so a
+lookup doesn't also write a counter shared by every request."""
+
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import board
+from logs import get_logger
+import metrics
+from models import Game
+
+MEMCACHE_GAME_STATE = 'GAME_STATE:{0}'
+MEMCACHE_GAME_STATE_HITS = 'GAME_STATE_HITS'
+MEMCACHE_GAME_STATE_MISSES = 'GAME_STATE_MISSES'
+
+# Finished games are still polled for a while, one day is plenty
+GAME_STATE_TTL = 24 * 60 * 60
+CAS_RETRIES = 3
+# Backoff between reads of a game's entry while waiting for it to change
+FIRST_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+# Hits and misses counted by an instance are added to memcache at most this
+# often, a lost instance loses its last few seconds of counts
+STATS_FLUSH_INTERVAL = 10
+
+log = get_logger('cache')
+
+_pending_stats = {MEMCACHE_GAME_STATE_HITS: 0, MEMCACHE_GAME_STATE_MISSES: 0}
+_stats_lock = threading.Lock()
+_last_stats_flush = [time.time()]
+
+_GAME_FIELDS = ('game_id', 'player1', 'player2', 'last_play_user_id',
+                'board', 'move_count', 'version', 'size', 'run_length')
+
+
+def _key(game_id):
+    return MEMCACHE_GAME_STATE.format(game_id)
+
+
+def _version(state):
+    return state.get('version') or 0, state['move_count']
+
+
+def game_state(game):
+    """Returns the dict stored in memcache for game"""
+    state = dict((field, getattr(game, field)) for field in _GAME_FIELDS)
+    state['turn'] = game.next_player_id()
+    state['result'] = game.result()
+    return state
+
+
+def _from_state(state):
+    # Fields missing from entries cached before they existed keep the model
+    # defaults
+    fields = dict((field, state[field]) for field in _GAME_FIELDS
+                  if state.get(field) is not None)
+    return Game(id=state['game_id'], outcome=state['result'], **fields)
+
+
+@ndb.tasklet
+def get_game_async(game_id):
+    """Tasklet returning the game for game_id, from memcache when possible.
+    Games rebuilt from memcache are not meant to be saved, None if not found"""
+    state = yield ndb.get_context().memcache_get(_key(game_id))
+    metrics.record_cache_lookup(state is not None)
+    if state is not None:
+        _count(MEMCACHE_GAME_STATE_HITS)
+        raise ndb.Return(_from_state(state))
+
+    _count(MEMCACHE_GAME_STATE_MISSES)
+    game = yield Game.get_by_game_id_async(game_id)
+    if game is not None:
+        yield set_game_async(game)
+    raise ndb.Return(game)
+
+
+@ndb.tasklet
+def set_game_async(game):
+    """Tasklet writing the state of game through to memcache with
+    compare-and-set, keeping whichever entry has the newer version"""
+    key = _key(game.game_id)
+    state = game_state(game)
+    context = ndb.get_context()
+    for _ in range(CAS_RETRIES):
+        cached = yield context.memcache_gets(key)
+        if cached is None:
+            added = yield context.memcache_add(key, state, time=GAME_STATE_TTL)
+            if added:
+                return
+            continue
+        if _version(cached) > _version(state):
+            return
+        stored = yield context.memcache_cas(key, state, time=GAME_STATE_TTL)
+        if stored:
+            return
+    # Too much contention, drop the entry so the next read goes to the datastore
+    log.warning('could not update cached game state', game_id=game.game_id)
+    yield context.memcache_delete(key)
+
+
+def wait_for_change(game_id, version, timeout):
+    """Waits up to timeout seconds for the game to move past version, reading
+    its memcache entry with an exponential backoff. Returns the game as soon
+    as its version differs or it has ended, otherwise as it is after timeout,
+    None if it doesn't exist. Every read is a get_game_async lookup, counted
+    as a hit or miss like any other, and an entry missing from memcache is
+    read from the datastore and cached again"""
+    deadline = time.time() + timeout
+    interval = FIRST_POLL_INTERVAL
+    while True:
+        game = get_game_async(game_id).get_result()
+        if (game is None or game.version != version or
+                game.result() != board.ONGOING):
+            return game
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return game
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+
+@ndb.tasklet
+def delete_games_async(game_ids):
+    context = ndb.get_context()
+    yield [context.memcache_delete(_key(game_id)) for game_id in game_ids]
+
+
+def _count(name):
+    with _stats_lock:
+        _pending_stats[name] += 1
+        due = time.time() - _last_stats_flush[0] >= STATS_FLUSH_INTERVAL
+    if due:
+        flush_stats()
+
+
+def flush_stats():
+    """Adds the hits and misses counted by this instance to memcache"""
+    with _stats_lock:
+        pending = dict((name, count) for name, count in _pending_stats.items()
+                       if count)
+        for name in _pending_stats:
+            _pending_stats[name] = 0
+        _last_stats_flush[0] = time.time()
+    if pending:
+        memcache.offset_multi(pending, initial_value=0)
+
+
+def get_stats():
+    """Returns (hits, misses) of the game state cache, as flushed by every
+    instance"""
+    flush_stats()
+    counters = memcache.get_multi([MEMCACHE_GAME_STATE_HITS,
+                                   MEMCACHE_GAME_STATE_MISSES])
+    return (counters.get(MEMCACHE_GAME_STATE_HITS, 0),
+            counters.get(MEMCACHE_GAME_STATE_MISSES, 0))
@@ -0,0 +1,45 @@
+"""counters.py - Sharded counters.
+
+A counter is split over SHARDS CounterShard entities, each its own entity
+group, and an increment only writes one shard picked at random, so frequent
+increments of the same counter don't contend on a single entity. Reading a
+counter sums its shards with one batch get."""
+
+import random
+
+from google.appengine.ext import ndb
+
+from models import CounterShard
+
+SHARDS = 20
+
+
+def _shard_key(name, index):
+    return ndb.Key(CounterShard, '{0}:{1}'.format(name, index))
+
+
+@ndb.tasklet
+def increment_async(name, delta=1):
+    """Tasklet adding delta to a random shard of the counter name. Call it
+    inside a transaction (cross group when other entities are written too) so
+    the increment commits, or not, with the rest of the transaction"""
+    key = _shard_key(name, random.randrange(SHARDS))
+    shard = yield key.get_async()
+    if shard is None:
+        shard = CounterShard(key=key)
+    shard.count += delta
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def get_counts_async(names):
+    """Tasklet returning a dict of counter name -> total, 0 for counters never
+    incremented"""
+    keys = [_shard_key(name, index)
+            for name in names for index in range(SHARDS)]
+    shards = yield ndb.get_multi_async(keys)
+    totals = dict((name, 0) for name in names)
+    for i, shard in enumerate(shards):
+        if shard is not None:
+            totals[names[i // SHARDS]] += shard.count
+    raise ndb.Return(totals)
@@ -0,0 +1,38 @@
+"""game_context.py - What one request knows about a game.
+
+An endpoint working on a game creates one GameContext and hands it to every
+helper it calls, so the game is looked up at most once per request, by
+whichever helper needs it first: from the game state cache, else from the
+datastore, migrating a legacy game on the way. Transactions still read the
+game in its entity group, and hand the version they saved to the context for
+the helpers running after them."""
+
+from google.appengine.ext import ndb
+
+import cache
+
+
+def _done(result):
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+class GameContext(object):
+    """Lazily loaded state of the game game_id, for one request"""
+
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self._game = None
+
+    def get_game_async(self):
+        """Future of the game, from the game state cache when possible, None
+        if it doesn't exist. The game may come from memcache and is not meant
+        to be saved"""
+        if self._game is None:
+            self._game = cache.get_game_async(self.game_id)
+        return self._game
+
+    def saved(self, game):
+        """Records the game a transaction of this request just saved"""
+        self._game = _done(game)
@@ -0,0 +1,101 @@
+"""game_stats.py - Running totals of games and moves.
+
+The totals are sharded counters (see counters) updated on each game
+transition: a game starting or ending, each counted once by a task queued in
+the transaction making it, or being deleted before it ended. Counting in tasks
+keeps the shards, shared by every game, out of the transactions of the games.
+A deleted game is only counted as abandoned if its start was counted. The
+/tasks/cache_average_attempts task sums the counters into a snapshot kept in
+memcache, so serving the totals is one memcache get whatever the number of
+games. Counting started when the counters were deployed, older games only
+show up once they end."""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import counters
+from models import Game
+
+MEMCACHE_GAME_STATS = 'GAME_STATS'
+# Snapshots are refreshed by task at most once per interval after a game ends,
+# and recomputed on read once they expire
+SNAPSHOT_INTERVAL = 60
+SNAPSHOT_TTL = 5 * 60
+
+GAMES_STARTED = 'games_started'
+GAMES_FINISHED = 'games_finished'
+GAMES_ABANDONED = 'games_abandoned'
+FINISHED_GAME_MOVES = 'finished_game_moves'
+COUNTERS = [GAMES_STARTED, GAMES_FINISHED, GAMES_ABANDONED,
+            FINISHED_GAME_MOVES]
+
+
+def schedule_start(game_id):
+    """Queues the counting of a new game. Call it in the transaction creating
+    the game so the task only exists if it commits"""
+    taskqueue.add(url='/tasks/record_start', params={'game_id': game_id},
+                  transactional=True)
+
+
+@ndb.transactional_tasklet(xg=True)
+def record_start_async(game_id):
+    """Tasklet counting a started game, in one cross group transaction with the
+    game so a retried task counts it only once. Games deleted before the task
+    ran are not counted"""
+    game = yield ndb.Key(Game, game_id).get_async()
+    if game is None or game.start_recorded:
+        return
+    game.start_recorded = True
+    yield counters.increment_async(GAMES_STARTED), game.put_async()
+
+
+@ndb.tasklet
+def record_finish_async(game):
+    """Counts an ended game and its moves, call it in a transaction writing
+    the game so the result is only counted once"""
+    yield (counters.increment_async(GAMES_FINISHED),
+           counters.increment_async(FINISHED_GAME_MOVES, game.move_count))
+
+
+@ndb.transactional_tasklet
+def record_abandoned_async(count):
+    """Counts games deleted before they ended"""
+    yield counters.increment_async(GAMES_ABANDONED, count)
+
+
+def schedule_snapshot():
+    """Queues a snapshot task, at most one per SNAPSHOT_INTERVAL"""
+    name = 'game-stats-{0}'.format(int(time.time()) // SNAPSHOT_INTERVAL)
+    try:
+        taskqueue.add(url='/tasks/cache_average_attempts', name=name,
+                      countdown=SNAPSHOT_INTERVAL)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def snapshot():
+    """Sums the counters, stores the totals in memcache and returns them"""
+    totals = counters.get_counts_async(COUNTERS).get_result()
+    finished = totals[GAMES_FINISHED]
+    moves = totals[FINISHED_GAME_MOVES]
+    stats = {
+        'games_started': totals[GAMES_STARTED],
+        'games_finished': finished,
+        # Games older than the counters can make this negative for a while
+        'games_active': max(totals[GAMES_STARTED] - finished -
+                            totals[GAMES_ABANDONED], 0),
+        'moves_played': moves,
+        'average_moves_per_game': float(moves) / finished if finished else 0.0,
+        'updated': int(time.time()),
+    }
+    memcache.set(MEMCACHE_GAME_STATS, stats, time=SNAPSHOT_TTL)
+    return stats
+
+
+def get_snapshot():
+    """Returns the totals cached by the last snapshot, taking a new one if it
+    expired"""
+    return memcache.get(MEMCACHE_GAME_STATS) or snapshot()
@@ -0,0 +1,92 @@
+"""idempotency.py - Stored responses of requests sent with an idempotency key.
+
+Clients may send startGame and makeMove with an idempotency key, unique to
+the request and sent again when they retry it. The response is then saved
+under the key as an IdempotentResponse in the entity group of the game, by
+the transaction making the change, so a request either changed the game and
+stored its response or did neither. For RESPONSE_TTL seconds, a retry gets
+that response back from memcache, or from the datastore, without the game
+logic running or writing again. Deleting a game drops the memcache copies of
+its responses, so a new game reusing its game_id doesn't get them."""
+
+import datetime
+import hashlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+from models import IdempotentResponse
+
+MEMCACHE_RESPONSE = 'IDEMPOTENT:{0}'
+RESPONSE_TTL = 24 * 60 * 60
+MAX_KEY_LENGTH = 100
+
+
+def _record_key(parent, endpoint, key):
+    return ndb.Key(IdempotentResponse, '{0}:{1}'.format(endpoint, key),
+                   parent=parent)
+
+
+def _memcache_key(record_key):
+    # Game ids and client keys together may exceed the memcache key size
+    return MEMCACHE_RESPONSE.format(
+        hashlib.md5(record_key.urlsafe()).hexdigest())
+
+
+def cached_response(parent, endpoint, key, message_type):
+    """Returns the response memcache holds for key, None on a miss or when
+    key is None. A miss doesn't mean the request is new, the transaction
+    making the change checks with get_stored_async"""
+    if key is None:
+        return None
+    encoded = memcache.get(_memcache_key(_record_key(parent, endpoint, key)))
+    if encoded is None:
+        return None
+    return protojson.decode_message(message_type, encoded)
+
+
+@ndb.tasklet
+def get_stored_async(parent, endpoint, key, message_type):
+    """Tasklet returning the response saved for key in the datastore, None if
+    there is none, it expired or key is None. Call it in the transaction
+    making the change, so a concurrent duplicate is seen"""
+    if key is None:
+        raise ndb.Return(None)
+    record = yield _record_key(parent, endpoint, key).get_async()
+    expiry = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=RESPONSE_TTL)
+    if record is None or record.created < expiry:
+        raise ndb.Return(None)
+    raise ndb.Return(protojson.decode_message(message_type, record.response))
+
+
+def get_response(parent, endpoint, key, message_type):
+    """Returns the response stored for key, from memcache or else the
+    datastore, None if there is none"""
+    response = cached_response(parent, endpoint, key, message_type)
+    if response is None:
+        response = get_stored_async(parent, endpoint, key,
+                                    message_type).get_result()
+    return response
+
+
+def save(parent, endpoint, key, response):
+    """Returns the unsaved IdempotentResponse holding response for key, put
+    it in the transaction making the change. The response is added to
+    memcache once the transaction commits"""
+    record_key = _record_key(parent, endpoint, key)
+    encoded = protojson.encode_message(response)
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(_memcache_key(record_key), encoded,
+                             time=RESPONSE_TTL))
+    return IdempotentResponse(key=record_key, response=encoded)
+
+
+@ndb.tasklet
+def delete_cached_async(keys):
+    """Tasklet dropping from memcache the responses among keys, a game's
+    entity group, call it when deleting them"""
+    context = ndb.get_context()
+    yield [context.memcache_delete(_memcache_key(key)) for key in keys
+           if key.kind() == IdempotentResponse._get_kind()]
@@ -0,0 +1,148 @@
+"""leaderboard.py - Per player results and rankings.
+
+When a game ends, a transactional task counts its result once, adding to the
+players' wins, losses or draws sharded counters. The counters are folded into
+one PlayerStats entity per player at most every FOLD_INTERVAL seconds, and the
+top LEADERBOARD_SIZE players are cached in memcache. Serving the leaderboard
+or a player's rank reads that cache, one entity, or counts the players ranked
+above, never the history of games."""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import board
+import counters
+import game_stats
+from models import Game, PlayerStats
+
+MEMCACHE_LEADERBOARD = 'LEADERBOARD'
+LEADERBOARD_SIZE = 100
+LEADERBOARD_TTL = 10 * 60
+
+# Ranks are only counted this far, players further down get no rank
+RANK_COUNT_LIMIT = 1000
+
+# A player's counters are folded into PlayerStats at most once per interval
+FOLD_INTERVAL = 60
+
+WINS = 'wins'
+LOSSES = 'losses'
+DRAWS = 'draws'
+
+
+def _counter(stat, user_id):
+    return 'player_{0}:{1}'.format(stat, user_id)
+
+
+def _result_counters(game):
+    """Names of the counters to increment for the result of a finished game"""
+    winner_id = game.winner_id()
+    if winner_id is None:
+        return [_counter(DRAWS, game.player1), _counter(DRAWS, game.player2)]
+    loser_id = game.player2 if winner_id == game.player1 else game.player1
+    return [_counter(WINS, winner_id), _counter(LOSSES, loser_id)]
+
+
+def schedule_result(game_id):
+    """Queues the recording of a finished game's result. Call it in the
+    transaction saving the final move so the task only exists if it commits"""
+    taskqueue.add(url='/tasks/record_result', params={'game_id': game_id},
+                  transactional=True)
+
+
+@ndb.transactional_tasklet(xg=True)
+def record_result_async(game_id):
+    """Tasklet adding the result of a finished game to its players' counters
+    and the game totals, in one cross group transaction with the game so a
+    retried task counts it only once. Returns the players whose stats need
+    folding, [] if the game is not found or not finished"""
+    game = yield Game.key_for(game_id).get_async()
+    if game is None or game.result() == board.ONGOING:
+        raise ndb.Return([])
+
+    if not game.stats_recorded:
+        game.stats_recorded = True
+        futures = [counters.increment_async(name)
+                   for name in _result_counters(game)]
+        futures.append(game_stats.record_finish_async(game))
+        yield futures + [game.put_async()]
+    raise ndb.Return([game.player1, game.player2])
+
+
+def schedule_fold(user_ids):
+    """Queues a fold of each player's counters into PlayerStats. Tasks are
+    named per player and interval, so at most one is queued per interval and
+    it runs after every result recorded before it was queued"""
+    interval = int(time.time()) // FOLD_INTERVAL
+    for user_id in user_ids:
+        name = 'fold-{0}-{1}'.format(
+            hashlib.md5(user_id.encode('utf-8')).hexdigest(), interval)
+        try:
+            taskqueue.add(url='/tasks/fold_player_stats', name=name,
+                          params={'user_id': user_id}, countdown=FOLD_INTERVAL)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+def fold(user_id):
+    """Saves the totals of the player's counters in their PlayerStats and
+    drops the cached leaderboard if the player may appear in it"""
+    names = [_counter(stat, user_id) for stat in (WINS, LOSSES, DRAWS)]
+    totals = counters.get_counts_async(names).get_result()
+    stats = PlayerStats(id=user_id, user_id=user_id, wins=totals[names[0]],
+                        losses=totals[names[1]], draws=totals[names[2]])
+    stats.put()
+
+    top = memcache.get(MEMCACHE_LEADERBOARD)
+    if top is not None and (
+            len(top) < LEADERBOARD_SIZE or stats.wins >= top[-1]['wins'] or
+            user_id in [entry['user_id'] for entry in top]):
+        memcache.delete(MEMCACHE_LEADERBOARD)
+    return stats
+
+
+def _top_players():
+    """The LEADERBOARD_SIZE players with most wins, as dicts, from memcache"""
+    top = memcache.get(MEMCACHE_LEADERBOARD)
+    if top is None:
+        players = PlayerStats.query().order(-PlayerStats.wins).fetch(
+            LEADERBOARD_SIZE)
+        top = [stats.to_dict(exclude=['updated']) for stats in players]
+        memcache.add(MEMCACHE_LEADERBOARD, top, time=LEADERBOARD_TTL)
+    return top
+
+
+def _ranked(top):
+    """Yields (rank, entry), players with the same wins share a rank"""
+    rank = 0
+    for i, entry in enumerate(top):
+        if i == 0 or entry['wins'] != top[i - 1]['wins']:
+            rank = i + 1
+        yield rank, entry
+
+
+def get_leaderboard(limit):
+    """Returns the top limit players as PlayerStats, with their ranks"""
+    return [(rank, PlayerStats(id=entry['user_id'], **entry))
+            for rank, entry in _ranked(_top_players()[:limit])]
+
+
+def get_ranking(user_id):
+    """Returns (rank, PlayerStats) of the player, (None, None) if none of
+    their games has been counted yet. The rank is None below the first
+    RANK_COUNT_LIMIT players"""
+    for rank, entry in _ranked(_top_players()):
+        if entry['user_id'] == user_id:
+            return rank, PlayerStats(id=user_id, **entry)
+
+    stats = PlayerStats.get_by_id(user_id)
+    if stats is None:
+        return None, None
+    ahead = PlayerStats.query(PlayerStats.wins > stats.wins).count(
+        RANK_COUNT_LIMIT)
+    return (ahead + 1 if ahead < RANK_COUNT_LIMIT else None), stats
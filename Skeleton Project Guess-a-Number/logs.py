@@ -0,0 +1,74 @@
+"""logs.py - Leveled, structured logging for the game API.
+
+Each module gets its own level from LOG_LEVELS. Log calls take a short message
+plus structured fields (game_id, user_id, latency_ms...) that end up as
+key=value pairs. Formatting is deferred to the logging handler, so a call
+below the module level does no string formatting at all, and high frequency
+debug output can be sampled."""
+
+import logging
+import random
+
+DEFAULT_LEVEL = logging.INFO
+
+# Per module levels, lower one to logging.DEBUG to trace a module
+LOG_LEVELS = {
+    'ai': logging.INFO,
+    'api': logging.INFO,
+    'cache': logging.INFO,
+    'main': logging.INFO,
+    'matchmaking': logging.INFO,
+    'metrics': logging.INFO,
+}
+
+
+class _Record(object):
+    """Message and fields of a log call, formatted only when emitted"""
+
+    def __init__(self, message, fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        if not self.fields:
+            return self.message
+        return '{0} {1}'.format(self.message, ' '.join(
+            '{0}={1}'.format(name, self.fields[name])
+            for name in sorted(self.fields)))
+
+
+class GameLogger(object):
+    """Thin wrapper over a logging.Logger taking structured fields"""
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(name)
+        self._logger.setLevel(LOG_LEVELS.get(name, DEFAULT_LEVEL))
+
+    def is_debug(self):
+        return self._logger.isEnabledFor(logging.DEBUG)
+
+    def log(self, level, message, **fields):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, '%s', _Record(message, fields))
+
+    def debug(self, message, **fields):
+        self.log(logging.DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.log(logging.INFO, message, **fields)
+
+    def warning(self, message, **fields):
+        self.log(logging.WARNING, message, **fields)
+
+    def error(self, message, **fields):
+        self.log(logging.ERROR, message, **fields)
+
+    def sampled_debug(self, rate, message, **fields):
+        """Logs at debug level for roughly rate (0 to 1) of the calls"""
+        if self.is_debug() and random.random() < rate:
+            self._logger.debug('%s', _Record(message, dict(fields,
+                                                            sample_rate=rate)))
+
+
+def get_logger(name):
+    return GameLogger(name)
@@ -2,40 +2,235 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import datetime
+import hashlib
 import logging
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import GuessANumberApi
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from api import GuessANumberApi, PURGE_CUTOFF_FORMAT
 
-from models import User
+import game_stats
+import leaderboard
+
+from logs import get_logger
+from models import User, Game, Move, ReminderLog, MatchTicket,\
+    LEGACY_MOVES_PER_GAME
+
+MIGRATION_BATCH_SIZE = 100
+PURGE_BATCH_SIZE = 100
+
+REMINDER_QUEUE = 'reminders'
+REMINDER_PAGE_SIZE = 100
+# Players emailed by one task
+REMINDER_BATCH_SIZE = 20
+# Unfinished games not played for this long get their players reminded
+REMINDER_IDLE = datetime.timedelta(hours=12)
+
+log = get_logger('main')
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
+        """Start today's reminder emails to the players of idle unfinished
+        games. Called using a cron job, the emails are sent by tasks"""
+        cutoff = datetime.datetime.utcnow() - REMINDER_IDLE
+        taskqueue.add(url='/tasks/send_reminders', queue_name=REMINDER_QUEUE,
+                      params={'cutoff': cutoff.strftime(PURGE_CUTOFF_FORMAT),
+                              'day': datetime.date.today().isoformat()})
+
+
+def _players_to_remind(game):
+    """The player expected to move, or both before the first move"""
+    user_id = game.next_player_id()
+    return [user_id] if user_id else game.players
+
+
+class QueueReminders(webapp2.RequestHandler):
+    def post(self):
+        """Queue reminder batches for the players of one page of unfinished
+        games idle since the cutoff, and chain the next page with a cursor.
+        Tasks are named after the page so a retry queues nothing twice"""
+        day = self.request.get('day')
+        cutoff = datetime.datetime.strptime(self.request.get('cutoff'),
+                                            PURGE_CUTOFF_FORMAT)
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(
+            Game.finished == False, Game.updated < cutoff).fetch_page(
+                REMINDER_PAGE_SIZE, start_cursor=cursor)
+
+        page = hashlib.md5(
+            self.request.get('cursor').encode('utf-8')).hexdigest()
+        user_ids = sorted(set(user_id for game in games
+                              for user_id in _players_to_remind(game)))
+        tasks = [taskqueue.Task(
+            url='/tasks/send_reminder_batch',
+            name='reminders-{0}-{1}-{2}'.format(day, page, i),
+            params={'day': day,
+                    'user_id': user_ids[i:i + REMINDER_BATCH_SIZE]})
+            for i in range(0, len(user_ids), REMINDER_BATCH_SIZE)]
+        if more and next_cursor:
+            tasks.append(taskqueue.Task(
+                url='/tasks/send_reminders',
+                name='reminders-{0}-{1}-next'.format(day, page),
+                params={'day': day, 'cutoff': self.request.get('cutoff'),
+                        'cursor': next_cursor.urlsafe()}))
+
+        if tasks:
+            try:
+                taskqueue.Queue(REMINDER_QUEUE).add(tasks)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                # Queued by an earlier attempt, the other tasks were added
+                pass
+        log.info('reminders queued', day=day, games=len(games),
+                 players=len(user_ids))
+        self.response.set_status(204)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Email a bounded batch of players about their games. Each email is
+        recorded in a ReminderLog as it is sent, so a retried task skips the
+        players already reminded that day"""
+        day = self.request.get('day')
+        user_ids = self.request.get_all('user_id')[:REMINDER_BATCH_SIZE]
+        sent = ndb.get_multi([ReminderLog.key_for(day, user_id)
+                              for user_id in user_ids])
+        pending = [user_id for user_id, reminder in zip(user_ids, sent)
+                   if reminder is None]
+        # Players are matched to their User by name
+        users = User.query(User.name.IN(pending)).fetch(
+            REMINDER_BATCH_SIZE) if pending else []
+
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        emailed = 0
         for user in users:
+            if not user.email:
+                continue
             subject = 'This is a reminder!'
-            body = 'Hello {}, try out Guess A Number!'.format(user.name)
+            body = 'Hello {}, your tic tac toe games are waiting for your ' \
+                   'move!'.format(user.name)
             # This will send test emails, the arguments to send_mail are:
             # from, to, subject, body
             mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
                            user.email,
                            subject,
                            body)
+            ReminderLog(key=ReminderLog.key_for(day, user.name),
+                        user_id=user.name).put()
+            emailed += 1
+        log.info('reminders sent', day=day, emailed=emailed,
+                 already_sent=len(user_ids) - len(pending))
+        self.response.set_status(204)
 
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+class CacheGameStats(webapp2.RequestHandler):
     def post(self):
-        """Update game listing announcement in memcache."""
-        GuessANumberApi._cache_average_attempts()
+        """Snapshot the running game totals to memcache"""
+        stats = game_stats.snapshot()
+        log.debug('game stats cached', **stats)
         self.response.set_status(204)
 
 
+class MigrateLegacyBoards(webapp2.RequestHandler):
+    def post(self):
+        """Re-key every legacy Game by its game_id and pack its Move entities
+        into the board string. Also deletes the Move entities left by games
+        migrated before moves were deleted with them. Handles one page of
+        games per task and chains itself with a cursor"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        legacy = [game for game in games if game.is_legacy]
+        for game in legacy:
+            Game.replace_legacy(game)
+        # Saving again fills in the fields used to list games
+        unlisted = [game for game in games if not game.is_legacy and
+                    (not game.players or game.updated is None)]
+        ndb.put_multi(unlisted)
+        leftovers = [Move.query(Move.game_id == game.game_id).fetch_async(
+            LEGACY_MOVES_PER_GAME, keys_only=True)
+            for game in games if not game.is_legacy]
+        move_keys = [key for future in leftovers
+                     for key in future.get_result()]
+        ndb.delete_multi(move_keys)
+        log.info('migrated games', legacy=len(legacy), unlisted=len(unlisted),
+                 moves_deleted=len(move_keys))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_boards',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+
+class PurgeGames(webapp2.RequestHandler):
+    def post(self):
+        """Delete one batch of games not updated since the cutoff and chain
+        the next batch with a cursor"""
+        cutoff = datetime.datetime.strptime(self.request.get('cutoff'),
+                                            PURGE_CUTOFF_FORMAT)
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query(Game.updated < cutoff).fetch_page(
+            PURGE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+
+        deleted = GuessANumberApi._delete_games_async(keys).get_result()
+        # Matchmaking tickets are only read while their players wait, each
+        # batch also drops as many expired ones
+        ticket_keys = MatchTicket.query(MatchTicket.created < cutoff).fetch(
+            PURGE_BATCH_SIZE, keys_only=True)
+        ndb.delete_multi(ticket_keys)
+        log.info('purged games', games=len(keys), children=deleted,
+                 tickets=len(ticket_keys))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/purge_games',
+                          params={'cutoff': self.request.get('cutoff'),
+                                  'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class RecordGameStart(webapp2.RequestHandler):
+    def post(self):
+        """Count a new game in the game totals"""
+        game_id = self.request.get('game_id')
+        game_stats.record_start_async(game_id).get_result()
+        log.debug('game start recorded', game_id=game_id)
+        self.response.set_status(204)
+
+
+class RecordGameResult(webapp2.RequestHandler):
+    def post(self):
+        """Add the result of a finished game to its players' counters and
+        schedule the folding of their stats"""
+        game_id = self.request.get('game_id')
+        user_ids = leaderboard.record_result_async(game_id).get_result()
+        leaderboard.schedule_fold(user_ids)
+        game_stats.schedule_snapshot()
+        log.info('game result recorded', game_id=game_id)
+        self.response.set_status(204)
+
+
+class FoldPlayerStats(webapp2.RequestHandler):
+    def post(self):
+        """Save the totals of a player's counters in their PlayerStats"""
+        stats = leaderboard.fold(self.request.get('user_id'))
+        log.debug('player stats folded', user_id=stats.user_id,
+                  wins=stats.wins, losses=stats.losses, draws=stats.draws)
+        self.response.set_status(204)
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/cache_average_attempts', CacheGameStats),
+    ('/tasks/send_reminders', QueueReminders),
+    ('/tasks/send_reminder_batch', SendReminderBatch),
+    ('/tasks/migrate_boards', MigrateLegacyBoards),
+    ('/tasks/purge_games', PurgeGames),
+    ('/tasks/record_start', RecordGameStart),
+    ('/tasks/record_result', RecordGameResult),
+    ('/tasks/fold_player_stats', FoldPlayerStats),
 ], debug=True)
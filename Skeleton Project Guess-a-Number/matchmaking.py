@@ -0,0 +1,146 @@
+"""matchmaking.py - Pairs players waiting for a game.
+
+Every player looking for an opponent gets a MatchTicket entity and waits in
+one of POOL_SLOTS memcache slots kept per board variant, one player per slot.
+A joiner takes a waiting player out of a slot, or puts itself in an empty
+one, with compare-and-set, so a waiting player is taken by a single joiner.
+The game of a pair is created in the transaction assigning it to both
+tickets, so a player is never paired twice, even when memcache loses a slot.
+Waiting players learn their game from memcache, or from their ticket."""
+
+import random
+import time
+import uuid
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from logs import get_logger
+from models import MatchTicket
+
+MEMCACHE_POOL_SLOT = 'MATCHMAKING:{0}x{1}:{2}'
+MEMCACHE_MATCH = 'MATCH:{0}'
+
+POOL_SLOTS = 8
+CAS_RETRIES = 5
+# A waiting player has to join again within this many seconds to keep its
+# place in the pool
+TICKET_TTL = 60
+# How long a join waits for an opponent before returning the ticket
+WAIT_SECONDS = 20
+FIRST_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+
+# Stored in a slot once its player is taken
+_EMPTY = 0
+
+log = get_logger('matchmaking')
+
+
+def _slot_keys(size, run_length):
+    return [MEMCACHE_POOL_SLOT.format(size, run_length, i)
+            for i in range(POOL_SLOTS)]
+
+
+def _is_waiting(entry):
+    return bool(entry) and entry['expires'] > time.time()
+
+
+def new_ticket(user_id, size, run_length):
+    """Saves and returns a new MatchTicket for user_id"""
+    ticket = MatchTicket(id=uuid.uuid4().hex, user_id=user_id, size=size,
+                         run_length=run_length)
+    ticket.put()
+    return ticket
+
+
+def get_ticket(ticket_id):
+    return MatchTicket.get_by_id(ticket_id) if ticket_id else None
+
+
+def new_game_id():
+    return 'match-{0}'.format(uuid.uuid4().hex)
+
+
+def pair(ticket):
+    """Takes a player waiting for the same variant as ticket out of the pool
+    and returns their ticket id. When nobody else is waiting, puts ticket in
+    the pool, or refreshes its place, and returns None"""
+    client = memcache.Client()
+    keys = _slot_keys(ticket.size, ticket.run_length)
+    ticket_id = ticket.key.id()
+    entry = {'ticket': ticket_id, 'user_id': ticket.user_id,
+             'expires': time.time() + TICKET_TTL}
+
+    for _ in range(CAS_RETRIES):
+        slots = client.get_multi(keys, for_cas=True)
+        waiting = [key for key in keys if _is_waiting(slots.get(key))]
+        own = [key for key in waiting if slots[key]['ticket'] == ticket_id]
+        others = [key for key in waiting if key not in own and
+                  slots[key]['user_id'] != ticket.user_id]
+        random.shuffle(others)
+
+        for key in others:
+            if client.cas(key, _EMPTY, time=TICKET_TTL):
+                for own_key in own:
+                    client.cas(own_key, _EMPTY, time=TICKET_TTL)
+                return slots[key]['ticket']
+
+        if own:
+            if client.cas(own[0], entry, time=TICKET_TTL):
+                return None
+            continue
+
+        free = [key for key in keys if key not in waiting]
+        random.shuffle(free)
+        for key in free:
+            if key in slots:
+                stored = client.cas(key, entry, time=TICKET_TTL)
+            else:
+                stored = client.add(key, entry, time=TICKET_TTL)
+            if stored:
+                return None
+
+    # The ticket keeps its place on its next join
+    log.warning('matchmaking pool contended', ticket=ticket_id)
+    return None
+
+
+def assign(ticket_ids, game_id):
+    """Sets game_id on the tickets unless one of them already has a game,
+    returns whether they were assigned. Call it in the transaction creating
+    the game"""
+    tickets = ndb.get_multi([ndb.Key(MatchTicket, ticket_id)
+                             for ticket_id in ticket_ids])
+    if any(ticket is None or ticket.game_id for ticket in tickets):
+        return False
+    for ticket in tickets:
+        ticket.game_id = game_id
+    ndb.put_multi(tickets)
+    return True
+
+
+def notify(ticket_ids, game_id):
+    """Tells the players waiting on the tickets about their game"""
+    memcache.set_multi(dict((MEMCACHE_MATCH.format(ticket_id), game_id)
+                            for ticket_id in ticket_ids), time=TICKET_TTL)
+
+
+def wait_for_game(ticket_id, timeout=WAIT_SECONDS):
+    """Waits for the ticket's game, polling memcache with an exponential
+    backoff, and returns its game_id. The ticket itself is read at the end,
+    None if there is still no game after timeout seconds"""
+    key = MEMCACHE_MATCH.format(ticket_id)
+    deadline = time.time() + timeout
+    interval = FIRST_POLL_INTERVAL
+    while True:
+        game_id = memcache.get(key)
+        if game_id is not None:
+            return game_id
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+    ticket = get_ticket(ticket_id)
+    return ticket.game_id if ticket is not None else None
@@ -0,0 +1,192 @@
+"""metrics.py - Per endpoint latency and RPC instrumentation.
+
+Endpoint handlers decorated with @instrumented record their wall time, the
+number of datastore RPCs they caused (counted with an apiproxy hook), their
+hits and misses in the game state cache (reported by cache) and the size of
+their response. Calls raising an exception, a conflict or a rejected request,
+are recorded too, flagged as errors with no response. Samples are buffered per
+instance and appended with compare-and-set to a rolling window in memcache,
+from which get_summary computes percentiles."""
+
+import functools
+import math
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from protorpc import protojson
+
+from logs import get_logger
+
+# Versioned with the sample tuple, windows of older samples are left out
+MEMCACHE_METRICS = 'METRICS:v2:{0}'
+
+# Samples kept per endpoint in memcache
+WINDOW_SIZE = 500
+# Buffered samples are written to memcache every FLUSH_EVERY samples or
+# FLUSH_INTERVAL seconds, whichever comes first
+FLUSH_EVERY = 20
+FLUSH_INTERVAL = 10
+CAS_RETRIES = 3
+
+# Fields of a sample tuple
+(WALL_MS, DATASTORE_RPCS, MEMCACHE_HITS, MEMCACHE_MISSES, RESPONSE_BYTES,
+ ERROR) = range(6)
+
+# Names of every instrumented endpoint handler
+ENDPOINTS = []
+
+# Callables given (endpoint, sample) for every recorded sample, used by the
+# local benchmark to see each call
+LISTENERS = []
+
+log = get_logger('metrics')
+
+_current = threading.local()
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = [time.time()]
+_hooked_proxy = [None]
+
+
+class _Counters(object):
+    """RPCs seen while the current request's handler runs"""
+
+    def __init__(self):
+        self.datastore_rpcs = 0
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+
+
+def _datastore_hook(service, call, request, response):
+    counters = getattr(_current, 'counters', None)
+    if counters is not None:
+        counters.datastore_rpcs += 1
+
+
+def record_cache_lookup(hit):
+    """Counts a game state cache lookup of the current request, memcache
+    calls made for other reasons, like compare-and-set writes, don't count"""
+    counters = getattr(_current, 'counters', None)
+    if counters is None:
+        return
+    if hit:
+        counters.memcache_hits += 1
+    else:
+        counters.memcache_misses += 1
+
+
+def _install_hooks():
+    """Hooks the current API proxy, which the testbed replaces in tests"""
+    proxy = apiproxy_stub_map.apiproxy
+    if _hooked_proxy[0] is proxy:
+        return
+    hooks = proxy.GetPostCallHooks()
+    hooks.Append('metrics_datastore', _datastore_hook, 'datastore_v3')
+    _hooked_proxy[0] = proxy
+
+
+def instrumented(method):
+    """Decorator for endpoint handlers, place it under @endpoints.method"""
+    name = method.__name__
+    ENDPOINTS.append(name)
+
+    @functools.wraps(method)
+    def wrapper(service, request):
+        _install_hooks()
+        counters = _current.counters = _Counters()
+        started = time.time()
+        try:
+            response = method(service, request)
+        except Exception:
+            _finish(name, counters, started, None)
+            raise
+        _finish(name, counters, started, response)
+        return response
+    return wrapper
+
+
+def _finish(name, counters, started, response):
+    """Records the sample of a call, response is None when it raised"""
+    _current.counters = None
+    wall_ms = (time.time() - started) * 1000
+    if response is None:
+        response_bytes, error = 0, 1
+    else:
+        response_bytes, error = len(protojson.encode_message(response)), 0
+    _record(name, (wall_ms, counters.datastore_rpcs, counters.memcache_hits,
+                   counters.memcache_misses, response_bytes, error))
+
+
+def _record(name, sample):
+    for listener in LISTENERS:
+        listener(name, sample)
+    with _pending_lock:
+        _pending.setdefault(name, []).append(sample)
+        due = (len(_pending[name]) >= FLUSH_EVERY or
+               time.time() - _last_flush[0] >= FLUSH_INTERVAL)
+    if due:
+        flush()
+
+
+def flush():
+    """Appends the buffered samples of every endpoint to memcache"""
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    for name, samples in pending.items():
+        _append(name, samples)
+
+
+def _append(name, samples):
+    key = MEMCACHE_METRICS.format(name)
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        window = client.gets(key)
+        if window is None:
+            if client.add(key, samples[-WINDOW_SIZE:]):
+                return
+            continue
+        if client.cas(key, (window + samples)[-WINDOW_SIZE:]):
+            return
+    log.warning('dropped metric samples', endpoint=name, samples=len(samples))
+
+
+def _percentile(values, percent):
+    """Nearest rank percentile of sorted values"""
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def get_summary():
+    """Returns a dict per endpoint with the percentiles and averages of its
+    rolling window, endpoints without samples are left out"""
+    flush()
+    windows = memcache.get_multi([MEMCACHE_METRICS.format(name)
+                                  for name in ENDPOINTS])
+    summary = []
+    for name in ENDPOINTS:
+        window = windows.get(MEMCACHE_METRICS.format(name))
+        if not window:
+            continue
+        count = len(window)
+        wall_ms = sorted(sample[WALL_MS] for sample in window)
+        rpcs = sorted(sample[DATASTORE_RPCS] for sample in window)
+        summary.append({
+            'endpoint': name,
+            'samples': count,
+            'p50_ms': _percentile(wall_ms, 50),
+            'p90_ms': _percentile(wall_ms, 90),
+            'p99_ms': _percentile(wall_ms, 99),
+            'avg_datastore_rpcs': float(sum(rpcs)) / count,
+            'p99_datastore_rpcs': _percentile(rpcs, 99),
+            'memcache_hits': sum(sample[MEMCACHE_HITS] for sample in window),
+            'memcache_misses': sum(sample[MEMCACHE_MISSES]
+                                   for sample in window),
+            'errors': sum(sample[ERROR] for sample in window),
+            'avg_response_bytes': float(sum(sample[RESPONSE_BYTES]
+                                            for sample in window)) / count,
+        })
+    return summary
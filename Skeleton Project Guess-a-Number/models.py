@@ -7,6 +7,24 @@ from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import board
+from board import BOARD_SIZE, MAX_BOARD_SIZE, EMPTY_CELL, PLAYER1_CELL,\
+		PLAYER2_CELL, EMPTY_BOARD, cell_index
+
+# Legacy games were created with one Move entity per cell
+LEGACY_MOVES_PER_GAME = BOARD_SIZE * BOARD_SIZE
+# Games not found by key are looked up by game_id in case they predate game_id
+# keys. Turn off once /tasks/migrate_boards has run, so that every game read
+# is a key get
+LEGACY_LOOKUPS = True
+# Undos are refused once they would leave more than this many entries in a
+# game's move log besides its standing moves, so the log never holds more than
+# this plus one entry per cell and reading it is always a bounded query
+UNDO_LOG_LIMIT = 100
+MAX_MOVE_EVENTS = UNDO_LOG_LIMIT + MAX_BOARD_SIZE * MAX_BOARD_SIZE
+# Besides its move log, a game's entity group holds at most one
+# IdempotentResponse per move and the one of startGame
+MAX_GAME_CHILDREN = 2 * MAX_MOVE_EVENTS + 1
 
 class User(ndb.Model):
 		"""User profile"""
@@ -15,7 +33,12 @@ class User(ndb.Model):
 		user_id = ndb.IntegerProperty()
 
 class Move(ndb.Model):
-		"Position on TicTacToe Board"
+		"""Position on TicTacToe Board. Legacy root entity linked to its game by
+		game_id only, no longer written: cells live on the Game and the moves in
+		its MoveEvent children. Deleted when their game is migrated"""
+		# Only read in batches by the migration, never twice in a request
+		_use_cache = False
+		_use_memcache = False
 
 		user_id = ndb.StringProperty()
 		x = ndb.IntegerProperty(required=True)
@@ -24,12 +47,295 @@ class Move(ndb.Model):
 		game_id = ndb.StringProperty()
 		description = ndb.StringProperty()
 
+class MoveEvent(ndb.Model):
+		"""One entry of the append-only move log of a game. Stored under the Game
+		key with its sequence number as id, so the log is written in the move's
+		transaction and read back with one ancestor query. An undo is logged as
+		an UNDO entry naming the cell taken back"""
+		# Only read by ancestor queries, which bypass ndb's caches anyway
+		_use_cache = False
+		_use_memcache = False
+
+		MOVE = 'move'
+		UNDO = 'undo'
+
+		sequence = ndb.IntegerProperty(required=True, indexed=False)
+		action = ndb.StringProperty(required=True, choices=(MOVE, UNDO), indexed=False)
+		user_id = ndb.StringProperty(indexed=False)
+		x = ndb.IntegerProperty(indexed=False)
+		y = ndb.IntegerProperty(indexed=False)
+		created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+		@classmethod
+		def history_query(cls, game_key):
+				"""Log of the game, oldest first, at most MAX_MOVE_EVENTS entries. Ids
+				are sequence numbers so the key order needs no composite index"""
+				return cls.query(ancestor=game_key).order(cls.key)
+
+		@staticmethod
+		def standing_moves(events):
+				"""Replays events, in sequence order, and returns the MOVE events not
+				taken back by a later UNDO"""
+				moves = []
+				for event in events:
+						if event.action == MoveEvent.MOVE:
+								moves.append(event)
+						elif moves:
+								moves.pop()
+				return moves
+
+		def to_form(self):
+				return MoveEventForm(sequence=self.sequence, action=self.action,
+														user_id=self.user_id, x=self.x, y=self.y,
+														created=str(self.created))
+
 class Game(ndb.Model):
+		"""Tic Tac Toe game on a size x size board, won with run_length in a row.
+		The whole board is packed into a single string with one character per
+		cell (row by row), so a move is one get and one put"""
+		# Requests hold on to the game they read (see game_context) and the game
+		# state cache keeps it in memcache, ndb's own memcache copy would only
+		# add memcache calls around every transactional put
+		_use_memcache = False
+
 		player1 = ndb.StringProperty()
 		player2 = ndb.StringProperty()
 		game_id = ndb.StringProperty(required=True)
 		last_play_user_id = ndb.StringProperty()
-		incomplete = ndb.BooleanProperty()		
+		incomplete = ndb.BooleanProperty()
+		board = ndb.StringProperty(indexed=False)
+		move_count = ndb.IntegerProperty(default=0)
+		# Kept in sync by _pre_put_hook so games can be listed with plain queries
+		players = ndb.StringProperty(repeated=True)
+		finished = ndb.BooleanProperty(default=False)
+		updated = ndb.DateTimeProperty(auto_now=True)
+		# Sequence number of the last MoveEvent, bumped by every move and undo.
+		# The board is a snapshot of the log up to this version
+		version = ndb.IntegerProperty(default=0)
+		# Set once the result of the finished game is added to the players' stats
+		stats_recorded = ndb.BooleanProperty(default=False, indexed=False)
+		# Set once the game is counted in the started games total
+		start_recorded = ndb.BooleanProperty(default=False, indexed=False)
+		size = ndb.IntegerProperty(default=BOARD_SIZE, indexed=False)
+		run_length = ndb.IntegerProperty(default=BOARD_SIZE, indexed=False)
+		# Result of the board, updated from the lines through each move played.
+		# Evaluated from the whole board when missing, as on older games
+		outcome = ndb.StringProperty(indexed=False)
+
+		def _pre_put_hook(self):
+				self.players = [p for p in (self.player1, self.player2) if p]
+				self.finished = self.board is not None and self.result() != board.ONGOING
+
+		@classmethod
+		def new_game(cls, game_id, player1, player2, size=BOARD_SIZE,
+								 run_length=BOARD_SIZE):
+				"""Returns a new, unsaved game with an empty board keyed by game_id"""
+				return cls(id=game_id, game_id=game_id, player1=player1,
+										player2=player2, board=board.empty_board(size), move_count=0,
+										size=size, run_length=run_length)
+
+		@classmethod
+		@ndb.transactional
+		def create(cls, game_id, player1, player2, size=BOARD_SIZE,
+						   run_length=BOARD_SIZE):
+				"""Creates and saves a new game in a single transaction. Returns None
+				if a game already exists for game_id"""
+				if cls.key_for(game_id).get() is not None:
+						return None
+				game = cls.new_game(game_id, player1, player2, size, run_length)
+				game.put()
+				return game
+
+		@classmethod
+		def key_for(cls, game_id):
+				return ndb.Key(cls, game_id)
+
+		@classmethod
+		@ndb.tasklet
+		def get_by_game_id_async(cls, game_id):
+				"""Tasklet returning the game for game_id or None. Games saved before
+				game_id became the key name are migrated on first read"""
+				if not game_id:
+						raise ndb.Return(None)
+				game = yield cls.key_for(game_id).get_async()
+				if game is None and LEGACY_LOOKUPS:
+						legacy = yield cls.query(cls.game_id == game_id).get_async()
+						if legacy is not None:
+								game = cls.replace_legacy(legacy)
+				raise ndb.Return(game)
+
+		@classmethod
+		def get_by_game_id(cls, game_id):
+				return cls.get_by_game_id_async(game_id).get_result()
+
+		def marker_for(self, user_id):
+				"""Board character used for user_id, None if not a player"""
+				if user_id == self.player1:
+						return PLAYER1_CELL
+				if user_id == self.player2:
+						return PLAYER2_CELL
+				return None
+
+		def owner_of(self, x, y):
+				"""Returns the user_id owning the [x,y] cell or None if available"""
+				cell = self.board[cell_index(x, y, self.size)]
+				if cell == PLAYER1_CELL:
+						return self.player1
+				if cell == PLAYER2_CELL:
+						return self.player2
+				return None
+
+		def contains(self, x, y):
+				return 0 <= x < self.size and 0 <= y < self.size
+
+		def is_available(self, x, y):
+				return self.board[cell_index(x, y, self.size)] == EMPTY_CELL
+
+		def available_moves(self):
+				return self.board.count(EMPTY_CELL)
+
+		def play(self, x, y, user_id):
+				"""Assigns the [x,y] cell to user_id. Does not save the game, returns
+				the MoveEvent to save with it in the same transaction"""
+				self._place(x, y, user_id)
+				return self._log(MoveEvent.MOVE, user_id, x, y)
+
+		def undo(self, user_id, events):
+				"""Takes back the last standing move of events, the game's move log,
+				if user_id played it and rebuilds the board from the log. Does not save
+				the game, returns the MoveEvent to save with it. Raises ValueError when
+				the move can't be taken back"""
+				moves = MoveEvent.standing_moves(events)
+				if len(moves) != self.move_count:
+						raise ValueError('Game has moves played before its move log')
+				if not moves:
+						raise ValueError('No moves to undo')
+				if self.result() != board.ONGOING:
+						# The result may already be counted in the players' stats
+						raise ValueError('Game already ended')
+				# Entries of the log beyond the standing moves, an undo adds two
+				if self.version - self.move_count + 2 > UNDO_LOG_LIMIT:
+						raise ValueError('Too many undos in this game')
+				last = moves[-1]
+				if last.user_id != user_id:
+						raise ValueError('Only the player who made the last move can undo it')
+				self.rebuild(moves[:-1])
+				return self._log(MoveEvent.UNDO, user_id, last.x, last.y)
+
+		def rebuild(self, moves):
+				"""Replaces the board snapshot by replaying moves, the standing MOVE
+				events of the log in order"""
+				self.board = board.empty_board(self.size)
+				self.move_count = 0
+				self.last_play_user_id = None
+				self.outcome = board.ONGOING
+				for move in moves:
+						self._place(move.x, move.y, move.user_id)
+
+		def _place(self, x, y, user_id):
+				"""Plays [x,y] on an ongoing game, the result is updated from the
+				lines through the cell only"""
+				i = cell_index(x, y, self.size)
+				self.board = self.board[:i] + self.marker_for(user_id) + self.board[i + 1:]
+				self.move_count += 1
+				self.last_play_user_id = user_id
+				self.outcome = board.result_after(self.board, self.size, self.run_length,
+																				  x, y, self.move_count)
+
+		def _log(self, action, user_id, x, y):
+				self.version += 1
+				return MoveEvent(parent=self.key, id=self.version, sequence=self.version,
+												 action=action, user_id=user_id, x=x, y=y)
+
+		def next_player_id(self):
+				"""Returns the user_id expected to move next, None if either player may
+				start"""
+				if self.last_play_user_id == self.player1:
+						return self.player2
+				if self.last_play_user_id == self.player2:
+						return self.player1
+				return None
+
+		def result(self):
+				"""Returns one of the board module results"""
+				if self.outcome is None:
+						self.outcome = board.evaluate_cells(self.board, self.size,
+																								self.run_length)
+				return self.outcome
+
+		def winner_id(self):
+				"""Returns the user_id of the winner or None"""
+				result = self.result()
+				if result == board.PLAYER1_WINS:
+						return self.player1
+				if result == board.PLAYER2_WINS:
+						return self.player2
+				return None
+
+		def to_form(self, message=None):
+				"""Returns a GameStateForm representation of the Game"""
+				result = self.result()
+				if result == board.ONGOING:
+						status = GameStatus.ACTIVE
+				elif result == board.DRAW:
+						status = GameStatus.DRAW
+				else:
+						status = GameStatus.WON
+				return GameStateForm(message=message, game_id=self.game_id,
+														 board=self.board, player1=self.player1,
+														 player2=self.player2, turn=self.next_player_id(),
+														 status=status, winner=self.winner_id(),
+														 move_count=self.move_count, version=self.version,
+														 size=self.size, run_length=self.run_length)
+
+		@property
+		def is_legacy(self):
+				"""Older games are stored under an auto generated id and may still
+				keep their cells as nine separate Move entities"""
+				return self.key.id() != self.game_id
+
+		@classmethod
+		def replace_legacy(cls, legacy):
+				"""Saves a legacy game again under its game_id, packing its Move
+				entities into the board, and deletes the old entity and the moves in
+				the same transaction, so everything left about the game is in its
+				entity group. Returns the keyed game"""
+				game = cls.new_game(legacy.game_id, legacy.player1, legacy.player2)
+				game.last_play_user_id = legacy.last_play_user_id
+				game.incomplete = legacy.incomplete
+				move_keys = []
+				if legacy.board is None:
+						move_keys = game.migrate_legacy_moves()
+				else:
+						game.board = legacy.board
+						game.move_count = legacy.move_count
+
+				@ndb.transactional(xg=True)
+				def swap():
+						existing = game.key.get()
+						if existing is not None:
+								return existing
+						game.put()
+						# One entity group per Move, at most 11 groups in all
+						ndb.delete_multi([legacy.key] + move_keys)
+						return game
+				return swap()
+
+		def migrate_legacy_moves(self):
+				"""Packs the legacy Move entities of this game into the board string.
+				Does not save the game nor delete the moves, returns their keys"""
+				cells = list(EMPTY_BOARD)
+				move_count = 0
+				moves = Move.query(Move.game_id == self.game_id).fetch(LEGACY_MOVES_PER_GAME)
+				for move in moves:
+						marker = self.marker_for(move.user_id)
+						if move.available or marker is None:
+								continue
+						cells[cell_index(move.x, move.y)] = marker
+						move_count += 1
+				self.board = ''.join(cells)
+				self.move_count = move_count
+				return [move.key for move in moves]
 
 
 
@@ -87,6 +393,62 @@ class Score(ndb.Model):
 												 date=str(self.date), guesses=self.guesses)
 
 
+class ReminderLog(ndb.Model):
+		"""Records a reminder email sent to a player, keyed by day and user_id,
+		so a retried reminder task skips the players it already emailed"""
+		user_id = ndb.StringProperty(required=True, indexed=False)
+		sent = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+		@classmethod
+		def key_for(cls, day, user_id):
+				return ndb.Key(cls, '{0}:{1}'.format(day, user_id))
+
+
+class CounterShard(ndb.Model):
+		"""One shard of a counter of the counters module, keyed name:index"""
+		count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class PlayerStats(ndb.Model):
+		"""Totals of a player's finished games, keyed by user_id. Folded from the
+		player's sharded counters so only wins, the ranking order, is indexed"""
+		user_id = ndb.StringProperty(required=True, indexed=False)
+		wins = ndb.IntegerProperty(default=0)
+		losses = ndb.IntegerProperty(default=0, indexed=False)
+		draws = ndb.IntegerProperty(default=0, indexed=False)
+		updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+		def to_form(self, rank=None):
+				return PlayerStatsForm(user_id=self.user_id, rank=rank, wins=self.wins,
+														   losses=self.losses, draws=self.draws,
+														   games=self.wins + self.losses + self.draws)
+
+
+class MatchTicket(ndb.Model):
+		"""A player looking for an opponent in the matchmaking pool, keyed by a
+		random ticket id. game_id is set in the transaction creating the game the
+		player was paired into"""
+		# Paired by other requests, a copy kept in the context would go stale
+		_use_cache = False
+
+		user_id = ndb.StringProperty(required=True, indexed=False)
+		size = ndb.IntegerProperty(required=True, indexed=False)
+		run_length = ndb.IntegerProperty(required=True, indexed=False)
+		game_id = ndb.StringProperty(indexed=False)
+		created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class IdempotentResponse(ndb.Model):
+		"""Response of a request sent with an idempotency key, keyed endpoint:key
+		under the game the request changed and saved in the same transaction.
+		Deleted with its game"""
+		# The idempotency module keeps the response in memcache itself
+		_use_memcache = False
+
+		response = ndb.TextProperty(required=True)
+		created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
 class GameForm(messages.Message):
 		"""GameForm for outbound game state information"""
 		urlsafe_key = messages.StringField(1, required=True)
@@ -122,6 +484,147 @@ class ScoreForms(messages.Message):
 		items = messages.MessageField(ScoreForm, 1, repeated=True)
 
 
+class MoveForm(messages.Message):
+		"""One move of a make_moves_batch request"""
+		game_id = messages.StringField(1, required=True)
+		user_id = messages.StringField(2, required=True)
+		x = messages.IntegerField(3, required=True)
+		y = messages.IntegerField(4, required=True)
+
+
+class MoveForms(messages.Message):
+		"""Ordered moves sent to make_moves_batch"""
+		moves = messages.MessageField(MoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+		"""Outcome of one move of a make_moves_batch request"""
+		game_id = messages.StringField(1)
+		user_id = messages.StringField(2)
+		x = messages.IntegerField(3)
+		y = messages.IntegerField(4)
+		applied = messages.BooleanField(5, required=True)
+		message = messages.StringField(6, required=True)
+
+
+class MoveResultForms(messages.Message):
+		"""Return one MoveResultForm per move, in request order"""
+		results = messages.MessageField(MoveResultForm, 1, repeated=True)
+
+
+class MoveEventForm(messages.Message):
+		"""One entry of a game's move log"""
+		sequence = messages.IntegerField(1, required=True)
+		action = messages.StringField(2, required=True)
+		user_id = messages.StringField(3)
+		x = messages.IntegerField(4)
+		y = messages.IntegerField(5)
+		created = messages.StringField(6)
+
+
+class MoveEventForms(messages.Message):
+		"""Return the move log of a game, oldest first"""
+		items = messages.MessageField(MoveEventForm, 1, repeated=True)
+
+
+class GameIdForm(messages.Message):
+		"""A game listed by show_game_ids, board and state only when requested"""
+		game_id = messages.StringField(1, required=True)
+		board = messages.StringField(2)
+		state = messages.StringField(3)
+
+
+class GameIdForms(messages.Message):
+		"""Return one page of GameIdForms"""
+		items = messages.MessageField(GameIdForm, 1, repeated=True)
+		next_cursor = messages.StringField(2)
+		more = messages.BooleanField(3)
+
+
+class PlayerStatsForm(messages.Message):
+		"""Results and rank of one player"""
+		user_id = messages.StringField(1, required=True)
+		rank = messages.IntegerField(2)
+		wins = messages.IntegerField(3)
+		losses = messages.IntegerField(4)
+		draws = messages.IntegerField(5)
+		games = messages.IntegerField(6)
+
+
+class PlayerStatsForms(messages.Message):
+		"""Return the top players, best first"""
+		items = messages.MessageField(PlayerStatsForm, 1, repeated=True)
+
+
+class GameStatsForm(messages.Message):
+		"""Running totals of all games"""
+		games_started = messages.IntegerField(1)
+		games_active = messages.IntegerField(2)
+		games_finished = messages.IntegerField(3)
+		moves_played = messages.IntegerField(4)
+		average_moves_per_game = messages.FloatField(5)
+		updated = messages.IntegerField(6)
+
+
+class MetricsForm(messages.Message):
+		"""Recent performance of one endpoint. memcache_hits and memcache_misses
+		count its lookups in the game state cache, errors the calls that raised"""
+		endpoint = messages.StringField(1, required=True)
+		samples = messages.IntegerField(2, required=True)
+		p50_ms = messages.FloatField(3)
+		p90_ms = messages.FloatField(4)
+		p99_ms = messages.FloatField(5)
+		avg_datastore_rpcs = messages.FloatField(6)
+		p99_datastore_rpcs = messages.IntegerField(7)
+		memcache_hits = messages.IntegerField(8)
+		memcache_misses = messages.IntegerField(9)
+		avg_response_bytes = messages.FloatField(10)
+		errors = messages.IntegerField(11)
+
+
+class MetricsForms(messages.Message):
+		"""Return the MetricsForm of every endpoint"""
+		items = messages.MessageField(MetricsForm, 1, repeated=True)
+
+
+class GameStatus(messages.Enum):
+		"""Status of a game"""
+		ACTIVE = 1
+		WON = 2
+		DRAW = 3
+
+
+class GameStateForm(messages.Message):
+		"""Compact state of a game. The board has one character per cell, row by
+		row: '-' empty, 'X' player1, 'O' player2. turn is None when either player
+		may move. Cell [x,y] is board[x * size + y]. When the version the client
+		already has is still current only game_id, version and not_modified are
+		set, with retry_after_ms when a long poll suggests when to poll again"""
+		message = messages.StringField(1)
+		game_id = messages.StringField(2)
+		board = messages.StringField(3)
+		player1 = messages.StringField(4)
+		player2 = messages.StringField(5)
+		turn = messages.StringField(6)
+		status = messages.EnumField(GameStatus, 7)
+		winner = messages.StringField(8)
+		move_count = messages.IntegerField(9)
+		version = messages.IntegerField(10)
+		not_modified = messages.BooleanField(11)
+		size = messages.IntegerField(12)
+		run_length = messages.IntegerField(13)
+		retry_after_ms = messages.IntegerField(14)
+
+
+class MatchmakingForm(messages.Message):
+		"""Outcome of joining matchmaking. game is the state of the game the
+		player was paired into, unset while they are still waiting, in which case
+		ticket has to be sent back on the next join to keep their place"""
+		ticket = messages.StringField(1)
+		matched = messages.BooleanField(2)
+		game = messages.MessageField(GameStateForm, 3)
+
+
 class StringMessage(messages.Message):
 		"""StringMessage-- outbound (single) string message"""
 		message = messages.StringField(1, required=True)